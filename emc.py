@@ -1,25 +1,38 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from sys import stderr, exit
+from sys import argv, stdin, stderr, exit
+import re
 from pprint import pprint
 from datetime import datetime
 from subprocess import CalledProcessError
-
-from src.meta import EMC_VERSION, DEFAULT_REGION, DEFAULT_INSTANCE_TYPE, INSTANCE_TYPES, DEFAULT_ICON, DEFAULT_MOTD, DEFAULT_OPEN_PORTS
-from src.db import db_read, db_write, xdg_data_home
-from src.coreos import generate_config, get_ami
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+
+from src.meta import EMC_VERSION, DEFAULT_REGION, DEFAULT_INSTANCE_TYPE, INSTANCE_TYPES, DEFAULT_ICON, DEFAULT_MOTD, DEFAULT_OPEN_PORTS, MC_PORT
+from src.meta import DEFAULT_TRIM_SECONDS
+from src.meta import DEFAULT_PROXY_INSTANCE_TYPE, DEFAULT_NETWORK_BACKENDS, PROXY_OPEN_PORTS, BACKEND_OPEN_PORTS, BACKEND_PROXIED_PORTS
+from src.db import db_read, db_write, db_update, xdg_data_home
+from src.coreos import generate_config, generate_unit, get_ami, world_spec, proxy_unit, LEGACY_WORLD
 from src.keys import ssh, scp_pull
-from src.mc import mc_start, mc_stop, mc_download_world
+from src.mc import mc_start, mc_stop, mc_download_world, mc_install_world, mc_remove_world, mc_ping, mc_rcon, mc_exec, free_memory, free_port, pick_host
+from src.rcon import RconError
+from src.logs import fetch_logs, indexed_worlds, merged_logs, parse_time, format_time
+import src.worlds as worlds
+from src.anvil import region_coords, TICKS_PER_SECOND
+from src.network import velocity_toml, network_set_backends, PROXY, BACKEND_ENV
 import src.ec2 as ec2
+import src.keys as keys
+import src.daemon as daemon
 
 
-def parse_args():
+def parse_args(argv=None):
     p = dict()
     sp = dict()
 
     p[''] = ArgumentParser(description="ephemeral minecraft server")
     p[''].add_argument('--version', action='version', version=EMC_VERSION)
+    p[''].add_argument('--no-daemon', action='store_true', help="run the command here even if an emc daemon is running")
     sp[''] = p[''].add_subparsers(required=True, dest='subcommand')
 
     p['ddns'] = sp[''].add_parser(
@@ -98,7 +111,7 @@ something like this:
     p['ddns update'].set_defaults(fn=sc_ddns_update)
     p['ddns update'].add_argument('name', help="the name provided when the server was launched")
 
-    p['list'] = sp[''].add_parser('list', help="show names of running servers")
+    p['list'] = sp[''].add_parser('list', help="show names of running servers and their worlds")
     p['list'].set_defaults(fn=sc_list)
 
     p['launch'] = sp[''].add_parser('launch', help="create and start a new server")
@@ -107,13 +120,19 @@ something like this:
     p['launch'].add_argument('--ops', metavar="OPLIST", required=True, help="comma-separated list of operator usernames")
     p['launch'].add_argument('--region', default=DEFAULT_REGION, help="AWS region")
     p['launch'].add_argument('--type', default=DEFAULT_INSTANCE_TYPE, choices=INSTANCE_TYPES.keys(), help="AWS instance type")
-    p['launch'].add_argument('--ddns', metavar="DOMAIN", help="update DDNS for given domain")
+    p['launch'].add_argument('--memory', help="RAM to allocate to this world's JVM, e.g. 2G (default: all the instance type allows)")
+    g = p['launch'].add_mutually_exclusive_group()
+    g.add_argument('--ddns', metavar="DOMAIN", help="update DDNS for given domain")
+    g.add_argument('--pack', action='store_true', help="run this world on an existing server with enough free RAM if there is one")
     p['launch'].add_argument('--motd', help="message to show in the server list")
     p['launch'].add_argument('--icon', metavar="URL", help="URL for an icon to show in the server list")
 
-    p['terminate'] = sp[''].add_parser('terminate', help="stop and delete a server")
+    p['terminate'] = sp[''].add_parser('terminate', help="stop and delete servers")
     p['terminate'].set_defaults(fn=sc_terminate)
-    p['terminate'].add_argument('name', help="the name provided when the server was launched")
+    p['terminate'].add_argument('names', metavar='name', nargs='+', help="the name provided when the server was launched")
+    p['terminate'].add_argument('--save', action='store_true', help="save every world on the servers first, and don't terminate if that fails")
+    p['terminate'].add_argument('--trim', metavar="SECONDS", type=float, nargs='?', const=DEFAULT_TRIM_SECONDS, help=f"with --save, drop chunks players spent less than SECONDS near (default {DEFAULT_TRIM_SECONDS})")
+    p['terminate'].add_argument('--no-wait', action='store_true', help="don't wait for AWS to report the servers terminated")
 
     p['info'] = sp[''].add_parser('info', help="get information about a running server")
     p['info'].set_defaults(fn=sc_info)
@@ -132,14 +151,30 @@ something like this:
     p['mc status'].add_argument('-f', action='store_true', help="follow minecraft process output")
     p['mc status'].add_argument('name', help="the name provided when the server was launched")
 
+    p['mc logs'] = sp['mc'].add_parser('logs', help="fetch new log lines and search the local copy")
+    p['mc logs'].set_defaults(fn=sc_mc_logs)
+    p['mc logs'].add_argument('--all', action='store_true', help="merge the logs of every world, including terminated ones")
+    p['mc logs'].add_argument('--since', metavar="TIME", type=parse_time, help="only show lines from this ISO 8601 time on (UTC unless given)")
+    p['mc logs'].add_argument('--until', metavar="TIME", type=parse_time, help="only show lines up to this ISO 8601 time")
+    p['mc logs'].add_argument('--search', metavar="QUERY", help="only show lines matching this full-text query, e.g. 'lag' or '\"can\'t keep up\"'")
+    p['mc logs'].add_argument('--offline', action='store_true', help="don't fetch new lines, only search what's stored locally")
+    p['mc logs'].add_argument('name', nargs='?', help="the name provided when the server was launched")
+
     p['mc save'] = sp['mc'].add_parser('save', help="save a world locally")
     p['mc save'].set_defaults(fn=sc_mc_save)
     p['mc save'].add_argument('name', help="the name provided when the server was launched")
+    p['mc save'].add_argument('--trim', metavar="SECONDS", type=float, nargs='?', const=DEFAULT_TRIM_SECONDS, help=f"drop chunks players spent less than SECONDS near (default {DEFAULT_TRIM_SECONDS})")
 
     p['mc console'] = sp['mc'].add_parser('console', help="connect to the minecraft console")
     p['mc console'].set_defaults(fn=sc_mc_console)
     p['mc console'].add_argument('name', help="the name provided when the server was launched")
 
+    p['mc exec'] = sp['mc'].add_parser('exec', help="run console commands on one or all worlds")
+    p['mc exec'].set_defaults(fn=sc_mc_exec)
+    p['mc exec'].add_argument('--all', action='store_true', help="run on every world instead of a named one")
+    p['mc exec'].add_argument('--script', metavar="FILE", action='append', default=[], help="also run each line of FILE as a command ('-' for stdin)")
+    p['mc exec'].add_argument('words', metavar="NAME|COMMAND", nargs='*', help="the world name (unless --all), then the command to run")
+
     p['mc start'] = sp['mc'].add_parser('start', help="start the minecraft process")
     p['mc start'].set_defaults(fn=sc_mc_start)
     p['mc start'].add_argument('name', help="the name provided when the server was launched")
@@ -152,14 +187,128 @@ something like this:
     p['mc stop'].set_defaults(fn=sc_mc_stop)
     p['mc stop'].add_argument('name', help="the name provided when the server was launched")
 
-    return p[''].parse_args()
+    p['mc ping'] = sp['mc'].add_parser('ping', help="query a world like the minecraft server list does")
+    p['mc ping'].set_defaults(fn=sc_mc_ping)
+    p['mc ping'].add_argument('name', help="the name provided when the server was launched")
+
+    p['mc remove'] = sp['mc'].add_parser('remove', help="stop a world and remove it from its server")
+    p['mc remove'].set_defaults(fn=sc_mc_remove)
+    p['mc remove'].add_argument('name', help="the name provided when the server was launched")
+
+    p['worlds'] = sp[''].add_parser('worlds', help="view, name and clean up saved worlds")
+    sp['worlds'] = p['worlds'].add_subparsers(required=True, dest='worlds_subcommand')
+
+    p['worlds list'] = sp['worlds'].add_parser('list', help="show saved worlds, oldest first")
+    p['worlds list'].set_defaults(fn=sc_worlds_list)
+    p['worlds list'].add_argument('world', nargs='?', help="only show saves of this world")
+
+    p['worlds show'] = sp['worlds'].add_parser('show', help="show everything known about a saved world")
+    p['worlds show'].set_defaults(fn=sc_worlds_show)
+    p['worlds show'].add_argument('snapshot', help="id or name of the saved world")
+
+    p['worlds name'] = sp['worlds'].add_parser('name', help="name a saved world so it's never pruned")
+    p['worlds name'].set_defaults(fn=sc_worlds_name)
+    p['worlds name'].add_argument('snapshot', help="id or name of the saved world")
+    p['worlds name'].add_argument('name', nargs='?', help="the new name; leave out to remove the name")
+
+    p['worlds trim'] = sp['worlds'].add_parser('trim', help="shrink a saved world by dropping chunks nobody stayed in")
+    p['worlds trim'].set_defaults(fn=sc_worlds_trim)
+    p['worlds trim'].add_argument('snapshot', help="id or name of the saved world")
+    p['worlds trim'].add_argument('--below', metavar="SECONDS", type=float, default=DEFAULT_TRIM_SECONDS, help="drop chunks players spent less than this long near")
+    p['worlds trim'].add_argument('--chunks', action='store_true', help="list every chunk with its inhabited time and size")
+    p['worlds trim'].add_argument('--dry-run', action='store_true', help="only report what would be dropped")
+
+    p['worlds prune'] = sp['worlds'].add_parser('prune', help="delete saved worlds a retention policy doesn't keep")
+    p['worlds prune'].set_defaults(fn=sc_worlds_prune)
+    p['worlds prune'].add_argument('--keep-last', metavar="N", type=int, help="keep the newest N saves of each world")
+    p['worlds prune'].add_argument('--daily', metavar="N", type=int, help="keep the newest save of each of the N most recent days that have saves")
+    p['worlds prune'].add_argument('--weekly', metavar="N", type=int, help="keep the newest save of each of the N most recent weeks that have saves")
+    p['worlds prune'].add_argument('--dry-run', action='store_true', help="only show what would be deleted")
+    p['worlds prune'].add_argument('--save', action='store_true', help="also apply this policy after every 'mc save'")
+
+    p['network'] = sp[''].add_parser('network', help="run a proxy in front of several servers to share players between them")
+    sp['network'] = p['network'].add_subparsers(required=True, dest='network_subcommand')
+
+    p['network list'] = sp['network'].add_parser('list', help="show networks and their backend servers")
+    p['network list'].set_defaults(fn=sc_network_list)
+
+    p['network launch'] = sp['network'].add_parser('launch', help="create a proxy and backend servers behind it")
+    p['network launch'].set_defaults(fn=sc_network_launch)
+    p['network launch'].add_argument('name', help="a name for this network; backends are named after it")
+    p['network launch'].add_argument('--backends', type=int, default=DEFAULT_NETWORK_BACKENDS, help="how many backend servers to start with")
+    p['network launch'].add_argument('--ops', metavar="OPLIST", required=True, help="comma-separated list of operator usernames")
+    p['network launch'].add_argument('--region', default=DEFAULT_REGION, help="AWS region")
+    p['network launch'].add_argument('--type', default=DEFAULT_INSTANCE_TYPE, choices=INSTANCE_TYPES.keys(), help="AWS instance type of the backends")
+    p['network launch'].add_argument('--proxy-type', default=DEFAULT_PROXY_INSTANCE_TYPE, choices=INSTANCE_TYPES.keys(), help="AWS instance type of the proxy")
+    p['network launch'].add_argument('--memory', help="RAM to allocate to each backend's JVM, e.g. 8G (default: all the instance type allows)")
+    p['network launch'].add_argument('--ddns', metavar="DOMAIN", help="update DDNS for given domain to point at the proxy")
+    p['network launch'].add_argument('--motd', help="message to show in the server list")
+    p['network launch'].add_argument('--icon', metavar="URL", help="URL for an icon to show in the server list")
+
+    p['network add'] = sp['network'].add_parser('add', help="launch another backend and add it to the proxy")
+    p['network add'].set_defaults(fn=sc_network_add)
+    p['network add'].add_argument('network', help="the name provided when the network was launched")
+    p['network add'].add_argument('name', nargs='?', help="a name for the new backend")
+
+    p['network remove'] = sp['network'].add_parser('remove', help="take a backend out of the proxy and terminate it")
+    p['network remove'].set_defaults(fn=sc_network_remove)
+    p['network remove'].add_argument('network', help="the name provided when the network was launched")
+    p['network remove'].add_argument('name', help="the name of the backend")
+
+    p['network terminate'] = sp['network'].add_parser('terminate', help="stop and delete a proxy and all its backends")
+    p['network terminate'].set_defaults(fn=sc_network_terminate)
+    p['network terminate'].add_argument('network', help="the name provided when the network was launched")
+    p['network terminate'].add_argument('--save', action='store_true', help="save every backend's world first, and don't terminate if that fails")
+    p['network terminate'].add_argument('--trim', metavar="SECONDS", type=float, nargs='?', const=DEFAULT_TRIM_SECONDS, help=f"with --save, drop chunks players spent less than SECONDS near (default {DEFAULT_TRIM_SECONDS})")
+    p['network terminate'].add_argument('--no-wait', action='store_true', help="don't wait for AWS to report the servers terminated")
+
+    p['daemon'] = sp[''].add_parser('daemon', help="keep state and connections warm and run other emc commands for faster responses")
+    p['daemon'].set_defaults(fn=sc_daemon)
+
+    return p[''].parse_args(argv)
+
+
+
+def _worlds(host_name, spec) -> dict:
+    return spec.get('worlds') or {host_name: LEGACY_WORLD}
+
+
+def _find_world(db, name) -> ('host_name', 'world'):
+    for host_name, spec in db.get('servers', {}).items():
+        worlds = _worlds(host_name, spec)
+        if name in worlds:
+            return host_name, worlds[name]
+    raise KeyError(name)
+
+
+def _name_taken(db, name) -> bool:
+    try:
+        _find_world(db, name)
+        return True
+    except KeyError:
+        return name in db.get('servers', {})
+
+
+def _get_world(db, name) -> ('host_name', 'instance', 'world'):
+    host_name, world = _find_world(db, name)
+    instance = ec2.Instance.from_dict(db['servers'][host_name])
+
+    if not instance.last_ip:
+        instance.wait_ip()
+
+        # last_ip may have updated
+        db['servers'][host_name] = instance.to_dict()
+        db_write(db)
 
+    return host_name, instance, world
 
 
 def sc_list(args):
-    servers = db_read().get('servers', [])
-    for name in servers:
+    servers = db_read().get('servers', {})
+    for name, spec in servers.items():
         print(name)
+        for world_name, world in _worlds(name, spec).items():
+            print(f"  {world_name} :{world['port']}")
 
 
 def sc_info(args):
@@ -185,6 +334,14 @@ def sc_info(args):
     pprint(db['servers'][args.name])
 
 
+def _confirm_cost(what: str, cost: float) -> bool:
+    print(f"You're launching {what}.\nThis will cost around:\n  ${cost:8.2f}/hr\n  ${cost*24:8.2f}/day\n  ${cost*24*31:8.2f}/mo\n  ${cost*24*365.25:8.2f}/yr\nuntil you turn it off. Okay? [y/N]", file=stderr)
+    if input().strip().lower() not in ('y', 'yes', 'ok', 'sure', 'fine', 'k', 'whatever', 'whatevs', 'ok boomer'):
+        print("Whew, that was close!", file=stderr)
+        return False
+    return True
+
+
 def sc_launch(args):
     db = db_read()
 
@@ -196,46 +353,156 @@ def sc_launch(args):
             print('ERROR: no ddns entry with that domain', file=stderr)
             return 3
 
-    try:
-        if args.name in db['servers']:
-            print('ERROR: server with that name already exists', file=stderr)
-            return 2
-    except KeyError:
-        db['servers'] = dict()
+    if _name_taken(db, args.name):
+        print('ERROR: server with that name already exists', file=stderr)
+        return 2
+    db.setdefault('servers', dict())
+
+    # the name ends up in unit, container and directory names on the server
+    if not re.fullmatch(r'[A-Za-z0-9_-]+', args.name):
+        print('ERROR: server names may only contain letters, digits, dashes and underscores', file=stderr)
+        return 9
 
     ops = args.ops.split(',')
-    memory = INSTANCE_TYPES[args.type]["jvm_memory"]
+    memory = args.memory or INSTANCE_TYPES[args.type]["jvm_memory"]
     icon = args.icon or DEFAULT_ICON
     motd = args.motd or DEFAULT_MOTD
-    config = generate_config(memory, icon, ops, motd)
+
+    host_name = pick_host(db['servers'], args.region, memory) if args.pack else None
+    if host_name:
+        instance = ec2.Instance.from_dict(db['servers'][host_name])
+        if not instance.last_ip:
+            try:
+                instance.wait_ip()
+            except TimeoutError as e:
+                print(e, file=stderr)
+                return 5
+
+        world = world_spec(args.name, free_port(instance.worlds), memory)
+        print(f"packing world {args.name} onto server {host_name} ({instance.instance_type}), port {world['port']}, {memory} of RAM for the JVM", file=stderr)
+        mc_install_world(instance, world, generate_unit(args.name, world, icon, ops, motd))
+
+        instance.worlds[args.name] = world
+        db['servers'][host_name] = instance.to_dict()
+        db_write(db)
+        return
+
+    world = world_spec(args.name, MC_PORT, memory)
+    if free_memory(args.type, {args.name: world}) < 0:
+        print(f"ERROR: a {args.type} instance can't give {memory} of RAM to one JVM", file=stderr)
+        return 10
+
+    config = generate_config({world['unit']: generate_unit(args.name, world, icon, ops, motd)})
 
     ami = get_ami(args.region)
 
     cost = INSTANCE_TYPES[args.type]["hourly_price"]
 
-    print(f"You're launching a {args.type} instance and allocating {memory} of RAM to the JVM.\nThis will cost around:\n  ${cost:8.2f}/hr\n  ${cost*24:8.2f}/day\n  ${cost*24*31:8.2f}/mo\n  ${cost*24*365.25:8.2f}/yr\nuntil you turn it off. Okay? [y/N]", file=stderr)
-    if input().strip().lower() not in ('y', 'yes', 'ok', 'sure', 'fine', 'k', 'whatever', 'whatevs', 'ok boomer'):
-        print("Whew, that was close!", file=stderr)
+    if not _confirm_cost(f"a {args.type} instance and allocating {memory} of RAM to the JVM", cost):
         return 6
 
     new_server = ec2.Instance.launch(config, args.region, args.type, ami, DEFAULT_OPEN_PORTS, ddns_url)
+    new_server.worlds = {args.name: world}
 
     db['servers'][args.name] = new_server.to_dict()
     db_write(db)
 
 
+# download every world on the given servers without restarting them, all at
+# once; returns False if any of them couldn't be saved
+def _final_save(db, hosts: {'host_name': 'instance'}, trim=None) -> bool:
+    saves = []
+    for host_name, instance in hosts.items():
+        if not instance.last_ip:
+            instance.wait_ip()
+            db['servers'][host_name] = instance.to_dict()
+        for name, world in _worlds(host_name, db['servers'][host_name]).items():
+            saves.append((host_name, instance, name, world))
+
+    with ThreadPoolExecutor(max_workers=len(saves) or 1) as pool:
+        results = [(host_name, name, pool.submit(_download_world, host_name, instance, name, world, False)) for host_name, instance, name, world in saves]
+
+    ok = True
+    for host_name, name, result in results:
+        try:
+            world_path, saved = result.result()
+        except (CalledProcessError, OSError) as e:
+            print(f"ERROR: couldn't save world {name}: {e}", file=stderr)
+            ok = False
+            continue
+        try:
+            _catalog_world(db, host_name, name, world_path, saved, trim)
+        except worlds.SNAPSHOT_ERRORS as e:
+            print(f"ERROR: couldn't read saved world {name} from {world_path}: {e}", file=stderr)
+            ok = False
+
+    # the servers stay up, so they shouldn't stay stopped
+    if not ok:
+        for host_name, instance, name, world in saves:
+            print(f"resuming minecraft process of {name}...", file=stderr, end=' ', flush=True)
+            try:
+                mc_start(instance, world)
+                print("ok", file=stderr)
+            except (CalledProcessError, OSError) as e:
+                print(e, file=stderr)
+
+    for key in worlds.prune(db, **db.get('retention', {})):
+        print(f"pruned saved world {key}", file=stderr)
+    db_write(db)
+    return ok
+
+
+# terminate all instances at once; returns the labels of those that failed
+def _terminate_all(instances: {'label': 'instance'}, wait=True) -> [str]:
+    with ThreadPoolExecutor(max_workers=len(instances) or 1) as pool:
+        jobs = {label: pool.submit(instance.terminate, wait) for label, instance in instances.items()}
+
+    failed = []
+    for label, job in jobs.items():
+        # boto, its waiters and the DDNS request all raise their own errors
+        try:
+            job.result()
+        except Exception as e:
+            print(f"ERROR: couldn't terminate {label}: {e}", file=stderr)
+            failed.append(label)
+            continue
+        print(f"{label} {'terminated' if wait else 'terminating'}", file=stderr)
+    return failed
+
+
 def sc_terminate(args):
     db = db_read()
     try:
-        instance = db['servers'].pop(args.name)
-        instance = ec2.Instance.from_dict(instance)
-        instance.terminate()
+        hosts = {name: ec2.Instance.from_dict(db['servers'][name]) for name in args.names}
     except KeyError:
         print('ERROR: no server with that name', file=stderr)
         return 1
 
+    # the proxy would keep sending players to a backend terminated behind its back
+    for name in args.names:
+        for network_name, network in db.get('networks', {}).items():
+            if name in network['backends']:
+                print(f"ERROR: {name} is a backend of network {network_name}; use 'network remove {network_name} {name}'", file=stderr)
+                return 18
+
+    if args.save:
+        try:
+            if not _final_save(db, hosts, args.trim):
+                print('ERROR: not terminating anything since saving failed', file=stderr)
+                return 16
+        except TimeoutError as e:
+            print(e, file=stderr)
+            return 5
+
+    failed = _terminate_all(hosts, wait=not args.no_wait)
+    for name in hosts:
+        if name not in failed:
+            db['servers'].pop(name)
     db_write(db)
 
+    if failed:
+        return 17
+
 
 def _ddns_add(domain, url):
     db = db_read()
@@ -286,21 +553,13 @@ def sc_ddns_list(args):
 def sc_ssh(args):
     db = db_read()
     try:
-        instance = ec2.Instance.from_dict(db['servers'][args.name])
+        host_name, instance, world = _get_world(db, args.name)
     except KeyError:
         print('ERROR: no server with that name', file=stderr)
         return 1
-
-    if not instance.last_ip:
-        try:
-            instance.wait_ip()
-        except TimeoutError as e:
-            print(e, file=stderr)
-            return 5
-
-        # last_ip may have updated
-        db['servers'][args.name] = instance.to_dict()
-        db_write(db)
+    except TimeoutError as e:
+        print(e, file=stderr)
+        return 5
 
     ssh(instance.last_ip, instance.keypair.private)
 
@@ -308,98 +567,298 @@ def sc_ssh(args):
 def sc_mc_save(args):
     db = db_read()
     try:
-        instance = ec2.Instance.from_dict(db['servers'][args.name])
+        host_name, instance, world = _get_world(db, args.name)
     except KeyError:
         print('ERROR: no server with that name', file=stderr)
         return 1
+    except TimeoutError as e:
+        print(e, file=stderr)
+        return 5
 
-    if not instance.last_ip:
-        try:
-            instance.wait_ip()
-        except TimeoutError as e:
-            print(e, file=stderr)
-            return 5
+    world_path, saved = _download_world(host_name, instance, args.name, world)
+
+    status = 0
+    try:
+        _catalog_world(db, host_name, args.name, world_path, saved, args.trim)
+    except worlds.SNAPSHOT_ERRORS as e:
+        print(f"ERROR: couldn't read saved world {args.name} from {world_path}: {e}", file=stderr)
+        status = 16
+    for key in worlds.prune(db, **db.get('retention', {})):
+        print(f"pruned saved world {key}", file=stderr)
+    db_write(db)
+    return status
 
-        # last_ip may have updated
-        db['servers'][args.name] = instance.to_dict()
-        db_write(db)
 
-    worlds_dir = xdg_data_home() / 'emc' / 'worlds'
+def _download_world(host_name, instance, name, world, resume=True) -> ('world_path', 'saved'):
+    worlds_dir = worlds.worlds_dir()
     worlds_dir.mkdir(parents=True, exist_ok=True)
-    world_name = datetime.utcnow().isoformat(timespec='seconds').replace(':', '')
-    world_path = worlds_dir / ('minecraft_world_' + world_name + '.tar.gz')
+    saved = datetime.utcnow().isoformat(timespec='seconds')
+    world_name = saved.replace(':', '')
+    world_path = worlds_dir / ('minecraft_world_' + name + '_' + world_name + worlds.SNAPSHOT_SUFFIX)
 
-    print("pausing minecraft process...", file=stderr, end=' ', flush=True)
-    mc_stop(instance)
-    print("ok")
+    print(f"pausing minecraft process of {name}...", file=stderr, flush=True)
+    mc_stop(instance, world)
 
-    print(f"downloading world from server {args.name} to local path {world_path}:", file=stderr)
+    print(f"downloading world {name} from server {host_name} to local path {world_path}:", file=stderr)
     print("scp connecting...", file=stderr, flush=True, end='\r')
-    mc_download_world(instance, world_path)
-    print(f"download succeeded", file=stderr)
+    mc_download_world(instance, world, world_path)
+    print(f"download of {name} succeeded", file=stderr)
+
+    if resume:
+        print(f"resuming minecraft process of {name}...", file=stderr, end=' ', flush=True)
+        mc_start(instance, world)
+        print("ok", file=stderr)
+
+    return world_path, saved
 
-    print("resuming minecraft process...", file=stderr, end=' ', flush=True)
-    mc_start(instance)
-    print("ok", file=stderr)
 
+def _catalog_world(db, host_name, name, world_path, saved, trim=None):
+    key = worlds.snapshot_id(world_path)
+    db.setdefault('snapshots', dict())[key] = worlds.snapshot_info(world_path, host_name, name, saved)
+    if trim is not None:
+        _trim(db, key, trim)
 
+
+# {unit}, {container} etc. in cmd are filled in from the world's spec
 def _run_cmd(server_nickname, cmd):
     db = db_read()
     try:
-        instance = ec2.Instance.from_dict(db['servers'][args.name])
+        host_name, instance, world = _get_world(db, server_nickname)
     except KeyError:
         print('ERROR: no server with that name', file=stderr)
         return 1
+    except TimeoutError as e:
+        print(e, file=stderr)
+        return 5
 
-    if not instance.last_ip:
-        try:
-            instance.wait_ip()
-        except TimeoutError as e:
-            print(e, file=stderr)
-            return 5
+    ssh(instance.last_ip, instance.keypair.private, [part.format(**world) for part in cmd])
 
-        # last_ip may have updated
-        db['servers'][args.name] = instance.to_dict()
-        db_write(db)
 
-    ssh(instance.last_ip, instance.keypair.private, cmd)
+def sc_mc_console(args):
+    db = db_read()
+    try:
+        host_name, instance, world = _get_world(db, args.name)
+    except KeyError:
+        print('ERROR: no server with that name', file=stderr)
+        return 1
+    except TimeoutError as e:
+        print(e, file=stderr)
+        return 5
 
+    # worlds from older emc versions don't publish rcon
+    if 'rcon_port' not in world:
+        try:
+            return _run_cmd(args.name, ['sudo', 'docker', 'exec', '-i', '{container}', 'rcon-cli'])
+        except CalledProcessError as e:
+            if e.returncode == 137:
+                return 0
+            raise e
 
-def sc_mc_console(args):
     try:
-        return _run_cmd(args.name, ['sudo', 'docker', 'exec', '-i', 'mc', 'rcon-cli'])
-    except CalledProcessError as e:
-        if e.returncode == 137:
-            return 0
-        raise e
+        with mc_rcon(instance, world) as rcon:
+            while True:
+                try:
+                    command = input('> ').strip()
+                except (EOFError, KeyboardInterrupt):
+                    print(file=stderr)
+                    return 0
+                if command:
+                    print(rcon.command(command))
+    except (OSError, RconError) as e:
+        print(e, file=stderr)
+        return 11
+
+
+def _exec_on(instance, world, commands) -> ['response'] or Exception:
+    try:
+        return mc_exec(instance, world, commands)
+    except (OSError, RconError) as e:
+        return e
+
+
+def sc_mc_exec(args):
+    db = db_read()
+    words = list(args.words)
+
+    if args.all:
+        names = [name for host_name, spec in db.get('servers', {}).items() for name, world in _worlds(host_name, spec).items() if 'rcon_port' in world]
+    elif words:
+        names = [words.pop(0)]
+    else:
+        print('ERROR: give a world name or --all', file=stderr)
+        return 1
+
+    commands = [' '.join(words)] if words else []
+    for script in args.script:
+        with (stdin if script == '-' else open(script)) as f:
+            commands.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    if not commands:
+        print('ERROR: no commands given', file=stderr)
+        return 1
+
+    targets = dict()
+    for name in names:
+        try:
+            host_name, instance, world = _get_world(db, name)
+        except KeyError:
+            print('ERROR: no server with that name', file=stderr)
+            return 1
+        except TimeoutError as e:
+            print(e, file=stderr)
+            return 5
+        if 'rcon_port' not in world:
+            print(f'ERROR: {name} was launched by an older emc without rcon access; use mc console', file=stderr)
+            return 12
+        targets[name] = (instance, world)
+
+    if not targets:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        results = {name: pool.submit(_exec_on, instance, world, commands) for name, (instance, world) in targets.items()}
+
+    ret = 0
+    for name, result in results.items():
+        responses = result.result()
+        if isinstance(responses, Exception):
+            print(f"[{name}] ERROR: {responses}", file=stderr)
+            ret = 11
+            continue
+        for command, response in zip(commands, responses):
+            print(f"[{name}] > {command}")
+            for line in response.splitlines():
+                print(f"[{name}] {line}")
+    return ret
 
 
 def sc_mc_status(args):
 
     if args.f:
         try:
-            return _run_cmd(args.name, ['sudo', 'journalctl', '-fu', 'minecraft-server.service'])
+            return _run_cmd(args.name, ['sudo', 'journalctl', '-fu', '{unit}'])
         except KeyboardInterrupt:
             return 0
 
     try:
-        return _run_cmd(args.name, ['sudo', 'systemctl', 'status', 'minecraft-server.service'])
+        return _run_cmd(args.name, ['sudo', 'systemctl', 'status', '{unit}'])
     except CalledProcessError as e:
         if e.returncode == 3:
             return 0
         raise e
 
 
+def _fetch_logs(instance, name, world) -> 'count' or Exception:
+    try:
+        return fetch_logs(instance, name, world)
+    except (CalledProcessError, OSError) as e:
+        return e
+
+
+def sc_mc_logs(args):
+    db = db_read()
+    indexed = indexed_worlds()
+
+    if args.all:
+        names = sorted({name for host_name, spec in db.get('servers', {}).items() for name in _worlds(host_name, spec)} | set(indexed))
+    elif args.name:
+        names = [args.name]
+    else:
+        print('ERROR: give a world name or --all', file=stderr)
+        return 1
+
+    targets = dict()
+    for name in names:
+        try:
+            _find_world(db, name)
+        except KeyError:
+            # terminated, but we may still have its logs
+            if name in indexed:
+                continue
+            print('ERROR: no server with that name', file=stderr)
+            return 1
+        if args.offline:
+            continue
+        try:
+            host_name, instance, world = _get_world(db, name)
+        except TimeoutError as e:
+            print(e, file=stderr)
+            continue
+        targets[name] = (instance, world)
+
+    if targets:
+        with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+            results = {name: pool.submit(_fetch_logs, instance, name, world) for name, (instance, world) in targets.items()}
+        for name, result in results.items():
+            count = result.result()
+            if isinstance(count, Exception):
+                print(f"couldn't fetch logs of {name}: {count}", file=stderr)
+            else:
+                print(f"fetched {count} new lines from {name}", file=stderr)
+
+    # worlds that were never fetched have no logs, and opening them would
+    # leave an empty index behind
+    fetched = [name for name in names if name in targets or name in indexed]
+    try:
+        for ts, name, message in merged_logs(fetched, since=args.since, until=args.until, search=args.search):
+            if len(names) > 1:
+                print(f"{format_time(ts)} [{name}] {message}")
+            else:
+                print(f"{format_time(ts)} {message}")
+    except sqlite3.OperationalError as e:
+        print(f"ERROR: bad search query: {e}", file=stderr)
+        return 13
+
+
 def sc_mc_start(args):
-    return _run_cmd(args.name, ['sudo', 'systemctl', 'start', 'minecraft-server.service'])
+    return _run_cmd(args.name, ['sudo', 'systemctl', 'start', '{unit}'])
 
 
 def sc_mc_restart(args):
-    return _run_cmd(args.name, ['sudo', 'systemctl', 'restart', 'minecraft-server.service'])
+    return _run_cmd(args.name, ['sudo', 'systemctl', 'restart', '{unit}'])
 
 
 def sc_mc_stop(args):
-    return _run_cmd(args.name, ['sudo', 'systemctl', 'stop', 'minecraft-server.service'])
+    return _run_cmd(args.name, ['sudo', 'systemctl', 'stop', '{unit}'])
+
+
+def sc_mc_ping(args):
+    db = db_read()
+    try:
+        host_name, instance, world = _get_world(db, args.name)
+    except KeyError:
+        print('ERROR: no server with that name', file=stderr)
+        return 1
+    except TimeoutError as e:
+        print(e, file=stderr)
+        return 5
+
+    try:
+        pprint(mc_ping(instance.last_ip, world['port']))
+    except OSError as e:
+        print(e, file=stderr)
+        return 11
+
+
+def sc_mc_remove(args):
+    db = db_read()
+    try:
+        host_name, instance, world = _get_world(db, args.name)
+    except KeyError:
+        print('ERROR: no server with that name', file=stderr)
+        return 1
+    except TimeoutError as e:
+        print(e, file=stderr)
+        return 5
+
+    if not instance.worlds or len(instance.worlds) < 2:
+        print(f'ERROR: {args.name} is the only world on server {host_name}; terminate the server instead', file=stderr)
+        return 12
+
+    mc_remove_world(instance, world)
+
+    del instance.worlds[args.name]
+    db['servers'][host_name] = instance.to_dict()
+    db_write(db)
 
 
 def sc_ddns_link(args):
@@ -470,6 +929,387 @@ def sc_ddns_update(args):
     db_write(db)
 
 
+def _launch_backend(network_name: str, network: dict, name: str, ami: str) -> 'new instance':
+    region = network['region']
+    world = world_spec(name, MC_PORT, network['memory'])
+    unit = generate_unit(name, world, network['icon'], network['ops'], network['motd'], env=BACKEND_ENV)
+    proxy_sg = ec2.security_group(region, PROXY_OPEN_PORTS)
+    backend_sg = ec2.security_group(region, BACKEND_PROXIED_PORTS, from_group=proxy_sg)
+
+    instance = ec2.Instance.launch(generate_config({world['unit']: unit}), region, network['type'], ami, BACKEND_OPEN_PORTS, extra_groups=[backend_sg])
+    instance.worlds = {name: world}
+    instance.network = network_name
+    return instance
+
+
+def sc_network_list(args):
+    networks = db_read().get('networks', {})
+    for name, network in networks.items():
+        print(f"{name} (proxy at {network['proxy'].get('last_ip')})")
+        for backend, address in network['backends'].items():
+            print(f"  {backend} {address}")
+
+
+def sc_network_launch(args):
+    db = db_read()
+    db.setdefault('servers', dict())
+    networks = db.setdefault('networks', dict())
+
+    ddns_url = None
+    if args.ddns:
+        try:
+            ddns_url = db['ddns'][args.ddns]
+        except KeyError:
+            print('ERROR: no ddns entry with that domain', file=stderr)
+            return 3
+
+    if args.name in networks:
+        print('ERROR: network with that name already exists', file=stderr)
+        return 2
+
+    names = [f"{args.name}-{i}" for i in range(1, args.backends + 1)]
+    if any(_name_taken(db, name) for name in names):
+        print('ERROR: server with that name already exists', file=stderr)
+        return 2
+
+    if not re.fullmatch(r'[A-Za-z0-9_-]+', args.name):
+        print('ERROR: server names may only contain letters, digits, dashes and underscores', file=stderr)
+        return 9
+
+    memory = args.memory or INSTANCE_TYPES[args.type]["jvm_memory"]
+    if free_memory(args.type, {args.name: world_spec(args.name, MC_PORT, memory)}) < 0:
+        print(f"ERROR: a {args.type} instance can't give {memory} of RAM to one JVM", file=stderr)
+        return 10
+
+    network = dict(
+            region=args.region,
+            type=args.type,
+            memory=memory,
+            ops=args.ops.split(','),
+            icon=args.icon or DEFAULT_ICON,
+            motd=args.motd or DEFAULT_MOTD,
+            backends=dict(),
+    )
+
+    ami = get_ami(args.region)
+
+    cost = args.backends * INSTANCE_TYPES[args.type]["hourly_price"] + INSTANCE_TYPES[args.proxy_type]["hourly_price"]
+    if not _confirm_cost(f"a {args.proxy_type} proxy and {args.backends} {args.type} backends, each allocating {memory} of RAM to the JVM", cost):
+        return 6
+
+    backends = dict()
+    for name in names:
+        backends[name] = _launch_backend(args.name, network, name, ami)
+        db['servers'][name] = backends[name].to_dict()
+        db_write(db)
+
+    try:
+        for name, instance in backends.items():
+            network['backends'][name] = f"{instance.wait_private_ip()}:{MC_PORT}"
+    except TimeoutError as e:
+        print(e, file=stderr)
+        return 5
+
+    config = generate_config(
+            {PROXY['unit']: proxy_unit.format(memory=INSTANCE_TYPES[args.proxy_type]["jvm_memory"], **PROXY)},
+            files={PROXY['config']: velocity_toml(network['backends'], network['motd'])},
+    )
+    proxy = ec2.Instance.launch(config, args.region, args.proxy_type, ami, PROXY_OPEN_PORTS, ddns_url)
+
+    network['proxy'] = proxy.to_dict()
+    networks[args.name] = network
+    db_write(db)
+
+
+def _get_proxy(db, network_name) -> ('network', 'instance'):
+    network = db['networks'][network_name]
+    proxy = ec2.Instance.from_dict(network['proxy'])
+
+    if not proxy.last_ip:
+        proxy.wait_ip()
+
+        # last_ip may have updated
+        network['proxy'] = proxy.to_dict()
+        db_write(db)
+
+    return network, proxy
+
+
+def sc_network_add(args):
+    db = db_read()
+    try:
+        network, proxy = _get_proxy(db, args.network)
+    except KeyError:
+        print('ERROR: no network with that name', file=stderr)
+        return 1
+    except TimeoutError as e:
+        print(e, file=stderr)
+        return 5
+
+    name = args.name
+    if name is None:
+        i = 1
+        while _name_taken(db, f"{args.network}-{i}"):
+            i += 1
+        name = f"{args.network}-{i}"
+    elif _name_taken(db, name):
+        print('ERROR: server with that name already exists', file=stderr)
+        return 2
+    elif not re.fullmatch(r'[A-Za-z0-9_-]+', name):
+        print('ERROR: server names may only contain letters, digits, dashes and underscores', file=stderr)
+        return 9
+
+    cost = INSTANCE_TYPES[network['type']]["hourly_price"]
+    if not _confirm_cost(f"another {network['type']} backend, allocating {network['memory']} of RAM to the JVM", cost):
+        return 6
+
+    instance = _launch_backend(args.network, network, name, get_ami(network['region']))
+    db['servers'][name] = instance.to_dict()
+    db_write(db)
+
+    try:
+        network['backends'][name] = f"{instance.wait_private_ip()}:{MC_PORT}"
+    except TimeoutError as e:
+        print(e, file=stderr)
+        return 5
+
+    network_set_backends(proxy, network['backends'], network['motd'])
+    db_write(db)
+
+
+def sc_network_remove(args):
+    db = db_read()
+    try:
+        network, proxy = _get_proxy(db, args.network)
+    except KeyError:
+        print('ERROR: no network with that name', file=stderr)
+        return 1
+    except TimeoutError as e:
+        print(e, file=stderr)
+        return 5
+
+    try:
+        del network['backends'][args.name]
+    except KeyError:
+        print('ERROR: no backend with that name in this network', file=stderr)
+        return 1
+
+    # players on the removed backend get sent back to the proxy before it goes
+    network_set_backends(proxy, network['backends'], network['motd'])
+
+    instance = db['servers'].pop(args.name, None)
+    if instance:
+        ec2.Instance.from_dict(instance).terminate()
+    db_write(db)
+
+
+def sc_network_terminate(args):
+    db = db_read()
+    try:
+        network = db['networks'][args.network]
+    except KeyError:
+        print('ERROR: no network with that name', file=stderr)
+        return 1
+
+    backends = {name: ec2.Instance.from_dict(db['servers'][name]) for name in network['backends'] if name in db['servers']}
+    if args.save:
+        try:
+            if not _final_save(db, backends, args.trim):
+                print('ERROR: not terminating anything since saving failed', file=stderr)
+                return 16
+        except TimeoutError as e:
+            print(e, file=stderr)
+            return 5
+
+    proxy_label = f"proxy of {args.network}"
+    failed = _terminate_all(dict(backends, **{proxy_label: ec2.Instance.from_dict(network['proxy'])}), wait=not args.no_wait)
+    if failed:
+        # keep what's left around so terminating can be retried
+        network['backends'] = {name: address for name, address in network['backends'].items() if name in failed}
+    else:
+        del db['networks'][args.network]
+    for name in backends:
+        if name not in failed:
+            db['servers'].pop(name)
+    db_write(db)
+
+    if failed:
+        return 17
+
+
+def _sizeof_fmt(size: int) -> str:
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def sc_worlds_list(args):
+    db = db_read()
+    if worlds.sync_catalog(db):
+        db_write(db)
+
+    catalog = db.get('snapshots', {})
+    for key, info in sorted(catalog.items(), key=lambda item: item[1]['saved']):
+        if args.world and info.get('world') != args.world:
+            continue
+        name = f" ({info['name']})" if info.get('name') else ''
+        print(f"{key}{name}  {info['saved']}  {info.get('world') or '-'}  {info.get('version') or '?'}  {_sizeof_fmt(info['size'])}")
+
+
+def sc_worlds_show(args):
+    db = db_read()
+    if worlds.sync_catalog(db):
+        db_write(db)
+
+    try:
+        key = worlds.find_snapshot(db, args.snapshot)
+    except KeyError:
+        print('ERROR: no saved world with that id or name', file=stderr)
+        return 14
+
+    pprint(dict(db['snapshots'][key], path=str(worlds.worlds_dir() / db['snapshots'][key]['file'])))
+
+
+def sc_worlds_name(args):
+    db = db_read()
+    if worlds.sync_catalog(db):
+        db_write(db)
+
+    try:
+        key = worlds.find_snapshot(db, args.snapshot)
+    except KeyError:
+        print('ERROR: no saved world with that id or name', file=stderr)
+        return 14
+
+    if args.name:
+        try:
+            if worlds.find_snapshot(db, args.name) != key:
+                print('ERROR: saved world with that name already exists', file=stderr)
+                return 2
+        except KeyError:
+            pass
+
+    db['snapshots'][key]['name'] = args.name
+    db_write(db)
+
+
+def _trim(db, key, below_seconds, dry_run=False, show_chunks=False):
+    analysis, drop = worlds.trim_snapshot(db, key, below_seconds, dry_run)
+
+    total = dropped = total_size = dropped_size = 0
+    for dimension, name, chunks in analysis:
+        rx, rz = region_coords(name)
+        doomed = drop.get((dimension, name), set())
+        for i, inhabited, size in chunks:
+            total += 1
+            total_size += size
+            if i in doomed:
+                dropped += 1
+                dropped_size += size
+            if show_chunks:
+                seconds = '?' if inhabited is None else f"{inhabited / TICKS_PER_SECOND:.1f}"
+                print(f"{dimension} {rx * 32 + i % 32} {rz * 32 + i // 32} {seconds}s {size}{' dropped' if i in doomed else ''}")
+
+    verb = 'would drop' if dry_run else 'dropped'
+    print(f"{verb} {dropped} of {total} chunks ({_sizeof_fmt(dropped_size)} of {_sizeof_fmt(total_size)} of region data) inhabited for less than {below_seconds:g}s", file=stderr)
+
+
+def sc_worlds_trim(args):
+    db = db_read()
+    if worlds.sync_catalog(db):
+        db_write(db)
+
+    try:
+        key = worlds.find_snapshot(db, args.snapshot)
+    except KeyError:
+        print('ERROR: no saved world with that id or name', file=stderr)
+        return 14
+
+    _trim(db, key, args.below, args.dry_run, args.chunks)
+    db_write(db)
+
+
+def sc_worlds_prune(args):
+    db = db_read()
+    worlds.sync_catalog(db)
+
+    policy = dict(keep_last=args.keep_last, daily=args.daily, weekly=args.weekly)
+    if all(v is None for v in policy.values()):
+        policy = db.get('retention', {})
+    elif args.save:
+        db['retention'] = policy
+
+    for key in worlds.prune(db, dry_run=args.dry_run, **policy):
+        print(f"{'would prune' if args.dry_run else 'pruned'} saved world {key}", file=stderr)
+    db_write(db)
+
+
+def _run_forwarded(argv):
+    ec2.forget_connections()
+    args = parse_args(argv)
+    return args.fn(args)
+
+
+def _daemon_regions(db) -> set:
+    return {spec['region'] for spec in db.get('servers', {}).values()} | {DEFAULT_REGION}
+
+
+# look up IPs the servers haven't had yet, so commands don't need to wait
+def _daemon_poll():
+    db = db_read()
+    for region in _daemon_regions(db):
+        ec2.get_ec2_client(region)
+
+    found = dict()
+    for name, spec in db.get('servers', {}).items():
+        if spec.get('last_ip'):
+            continue
+        ip = ec2.Instance.from_dict(spec).get_ip()
+        if ip:
+            found[name] = (spec['instance_id'], ip)
+
+    # commands may have changed emc.json while we asked AWS, so only fill in
+    # the IPs of servers that are still the ones we looked up
+    def fill_in_ips(db):
+        changed = False
+        for name, (instance_id, ip) in found.items():
+            spec = db.get('servers', {}).get(name)
+            if spec and spec['instance_id'] == instance_id and not spec.get('last_ip'):
+                spec['last_ip'] = ip
+                changed = True
+        return changed
+
+    if found:
+        db_update(fill_in_ips)
+
+
+def sc_daemon(args):
+    control_dir = xdg_data_home() / 'emc' / 'ssh'
+    control_dir.mkdir(parents=True, exist_ok=True)
+    control_dir.chmod(0o700)
+    keys.control_dir = control_dir
+
+    import requests
+    db = db_read()
+    for region in _daemon_regions(db):
+        ec2.get_ec2_client(region)
+
+    print(f"emc daemon listening on {daemon.socket_path()}", file=stderr)
+    try:
+        daemon.serve(_run_forwarded, _daemon_poll)
+    except RuntimeError as e:
+        print(f"ERROR: {e}", file=stderr)
+        return 15
+    except KeyboardInterrupt:
+        return 0
+
+
 if __name__ == '__main__':
     args = parse_args()
+    if args.fn is not sc_daemon and not args.no_daemon:
+        status = daemon.forward(argv[1:])
+        if status is not None:
+            exit(status)
     exit(args.fn(args))
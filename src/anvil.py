@@ -0,0 +1,165 @@
+import gzip
+import os
+import struct
+import sys
+import tarfile
+import zlib
+from array import array
+from collections import deque
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path, PurePosixPath
+
+SECTOR = 4096
+CHUNKS = 1024
+
+COMPRESSION_GZIP = 1
+COMPRESSION_ZLIB = 2
+COMPRESSION_NONE = 3
+COMPRESSION_EXTERNAL = 128
+
+TICKS_PER_SECOND = 20
+
+# chunks store it as a long right in their root (1.18+) or in Level, either way
+# a search for the tag beats decoding the whole chunk
+_inhabited_tag = b'\x04\x00\x0dInhabitedTime'
+
+# region/ holds the terrain; since 1.17 entities/ and poi/ hold more data for
+# the same chunks in files with the same names
+REGION_DIRS = ('region', 'entities', 'poi')
+
+
+def read_header(data: bytes) -> ('offsets', 'sector counts'):
+    locations = array('I', data[:SECTOR])
+    if sys.byteorder == 'little':
+        locations.byteswap()
+    return [loc >> 8 for loc in locations], [loc & 0xff for loc in locations]
+
+
+def _chunk(data: bytes, offset: int) -> (int, bytes):
+    start = offset * SECTOR
+    length, compression = struct.unpack('>iB', data[start:start + 5])
+    return compression, data[start + 5:start + 4 + length]
+
+
+def inhabited_time(compression: int, payload: bytes):
+    if compression == COMPRESSION_GZIP:
+        payload = gzip.decompress(payload)
+    elif compression == COMPRESSION_ZLIB:
+        payload = zlib.decompress(payload)
+    elif compression != COMPRESSION_NONE:
+        return None
+
+    i = payload.find(_inhabited_tag)
+    if i < 0:
+        return None
+    i += len(_inhabited_tag)
+    return struct.unpack('>q', payload[i:i + 8])[0]
+
+
+# returns (index, inhabited ticks or None if unknown, bytes on disk) for every
+# chunk present; index is x + 32 * z within the region
+def analyze_region(data: bytes) -> [(int, int, int)]:
+    if len(data) < 2 * SECTOR:
+        return []
+    offsets, counts = read_header(data)
+    chunks = []
+    for i, (offset, count) in enumerate(zip(offsets, counts)):
+        if not offset or offset * SECTOR >= len(data):
+            continue
+        try:
+            inhabited = inhabited_time(*_chunk(data, offset))
+        except (zlib.error, OSError, EOFError, struct.error):
+            inhabited = None
+        chunks.append((i, inhabited, count * SECTOR))
+    return chunks
+
+
+# rewrite a region file without the dropped chunks and without gaps between
+# the rest; returns None if nothing would be left
+def compact_region(data: bytes, drop: set) -> bytes:
+    if len(data) < 2 * SECTOR:
+        return data
+    offsets, counts = read_header(data)
+    locations = array('I', [0] * CHUNKS)
+    body = bytearray()
+    for i, (offset, count) in enumerate(zip(offsets, counts)):
+        if not offset or i in drop or offset * SECTOR >= len(data):
+            continue
+        start = offset * SECTOR
+        length = struct.unpack('>i', data[start:start + 4])[0] + 4
+        sectors = -(-length // SECTOR)
+        locations[i] = ((2 + len(body) // SECTOR) << 8) | sectors
+        body += data[start:start + length]
+        body += bytes(sectors * SECTOR - length)
+
+    if not body:
+        return None
+    if sys.byteorder == 'little':
+        locations.byteswap()
+    return locations.tobytes() + data[SECTOR:2 * SECTOR] + bytes(body)
+
+
+def region_coords(name: str) -> (int, int):
+    _, x, z, _ = name.split('.')
+    return int(x), int(z)
+
+
+def _region_key(member_name: str):
+    path = PurePosixPath(member_name)
+    if path.suffix != '.mca' or path.parent.name not in REGION_DIRS:
+        return None
+    return str(path.parent.parent), path.parent.name, path.name
+
+
+def _analyze_member(args):
+    key, data = args
+    return key, analyze_region(data)
+
+
+# one pass over a world archive, analyzing region files in parallel; yields
+# (dimension dir, region file name, chunk list)
+def analyze_archive(path: Path):
+    # bound the region files held in memory while workers catch up
+    limit = 2 * (os.cpu_count() or 1)
+    with ProcessPoolExecutor() as pool, tarfile.open(path, 'r|gz') as tar:
+        pending = deque()
+        for member in tar:
+            key = _region_key(member.name) if member.isfile() else None
+            if key is None or key[1] != 'region':
+                continue
+            pending.append(pool.submit(_analyze_member, ((key[0], key[2]), tar.extractfile(member).read())))
+            while len(pending) > limit:
+                (dimension, name), chunks = pending.popleft().result()
+                yield dimension, name, chunks
+        while pending:
+            (dimension, name), chunks = pending.popleft().result()
+            yield dimension, name, chunks
+
+
+def chunks_below(analysis, below_ticks: int) -> {('dimension', 'region name'): {'index'}}:
+    drop = dict()
+    for dimension, name, chunks in analysis:
+        doomed = {i for i, inhabited, _ in chunks if inhabited is not None and inhabited < below_ticks}
+        if doomed:
+            drop[(dimension, name)] = doomed
+    return drop
+
+
+# copy a world archive to dest, leaving out the given chunks of every region,
+# entities and poi file
+def trim_archive(path: Path, dest: Path, drop: dict):
+    with tarfile.open(path, 'r|gz') as src, tarfile.open(dest, 'w:gz') as dst:
+        for member in src:
+            key = _region_key(member.name) if member.isfile() else None
+            doomed = key and drop.get((key[0], key[2]))
+            if not doomed:
+                dst.addfile(member, src.extractfile(member) if member.isfile() else None)
+                continue
+
+            data = compact_region(src.extractfile(member).read(), doomed)
+            if data is None:
+                continue
+            member.size = len(data)
+            dst.addfile(member, BytesIO(data))
+
@@ -1,10 +1,13 @@
 import json
-import requests
+from secrets import token_urlsafe
+from urllib.parse import quote
+
+from .meta import MC_PORT, RCON_PORT
 
 header = '''\
 [Unit]
-Description=Minecraft server
-After=network-online.target
+Description=Minecraft server ({name})
+After=network-online.target docker.service
 Wants=network-online.target
 
 [Install]
@@ -12,29 +15,81 @@ WantedBy=multi-user.target
 
 [Service]
 TimeoutStartSec=0
-ExecStartPre=/bin/mkdir -p /var/lib/minecraft
-ExecStartPre=/bin/chown 1000 /var/lib/minecraft
-ExecStartPre=-/bin/docker create --name mc -p 25565:25565 -v /var/lib/minecraft:/data:Z -e EULA=TRUE -e ANNOUNCE_PLAYER_ACHIEVEMENTS=true -e ENABLE_COMMAND_BLOCK=true -e SNOOPER_ENABLED=false\
+ExecStartPre=/bin/mkdir -p {data}
+ExecStartPre=/bin/chown 1000 {data}
+ExecStartPre=-/bin/docker create --name {container} -p {port}:25565 -v {data}:/data:Z -e EULA=TRUE -e ANNOUNCE_PLAYER_ACHIEVEMENTS=true -e ENABLE_COMMAND_BLOCK=true -e SNOOPER_ENABLED=false\
 '''
 
 footer = '''\
 itzg/minecraft-server
-ExecStart=/bin/docker start -a mc
-ExecStopPost=/usr/bin/tar czvf /tmp/minecraft_world.tar.gz /var/lib/minecraft
+ExecStart=/bin/docker start -a {container}
+ExecStopPost=/usr/bin/tar czvf {archive} {data}
 '''
 
+proxy_unit = '''\
+[Unit]
+Description=Minecraft proxy
+After=network-online.target docker.service
+Wants=network-online.target
+
+[Install]
+WantedBy=multi-user.target
+
+[Service]
+TimeoutStartSec=0
+ExecStartPre=/bin/mkdir -p {data}
+ExecStartPre=/bin/touch {console}
+ExecStartPre=/bin/chown -R 1000 {data}
+ExecStartPre=-/bin/docker create -i --name {container} -p {port}:25577 -v {data}:/server:Z -e TYPE=VELOCITY -e "MEMORY={memory}" itzg/mc-proxy
+ExecStart=/bin/sh -c 'tail -n 0 -f {console} | /bin/docker start -ai {container}'
+'''
+
+# servers launched before emc could pack several worlds onto one instance run
+# exactly one world under these fixed names
+LEGACY_WORLD = dict(
+        port=MC_PORT,
+        memory=None,
+        unit="minecraft-server.service",
+        container="mc",
+        data="/var/lib/minecraft",
+        archive="/tmp/minecraft_world.tar.gz",
+)
+
 
 double_quote = '"'
 escaped_double_quote = '\\"'
 
-def generate_config(memory: '12G', icon: 'url', ops: ['username'], motd: str):
+# rcon is only published on the server's loopback interface, emc reaches it
+# through an ssh tunnel
+def world_spec(name: str, port: int, memory: '12G') -> dict:
+    return dict(
+            port=port,
+            rcon_port=RCON_PORT + port - MC_PORT,
+            rcon_password=token_urlsafe(16),
+            memory=memory,
+            unit=f"minecraft-{name}.service",
+            container=f"mc-{name}",
+            data=f"/var/lib/minecraft/{name}",
+            archive=f"/tmp/minecraft_world_{name}.tar.gz",
+    )
+
+
+def generate_unit(name: str, world: dict, icon: 'url', ops: ['username'], motd: str, env: {'NAME': 'value'} = None) -> str:
     args = [
-        f'-e "MEMORY={memory}"',
+        f'-e "MEMORY={world["memory"]}"',
         f'-e ICON={icon}',
         f'-e OPS={",".join(ops)}',
         f'-e "MOTD={motd.replace(double_quote, escaped_double_quote)}"',
+        f'-p 127.0.0.1:{world["rcon_port"]}:25575',
+        f'-e ENABLE_RCON=true',
+        f'-e RCON_PASSWORD={world["rcon_password"]}',
     ]
+    args.extend(f'-e "{k}={v}"' for k, v in (env or {}).items())
+
+    return ' '.join([header.format(name=name, **world)] + args + [footer.format(**world)])
 
+
+def generate_config(units: {'unit name': 'contents'}, files: {'path': 'contents'} = None):
     config = {
         "ignition": {
             "version": "3.1.0",
@@ -42,18 +97,32 @@ def generate_config(memory: '12G', icon: 'url', ops: ['username'], motd: str):
         "systemd": {
             "units": [
                 {
-                    "contents": ' '.join([header] + args + [footer]),
+                    "contents": contents,
                     "enabled": True,
-                    "name": "minecraft-server.service",
-                },
+                    "name": unit,
+                }
+                for unit, contents in units.items()
             ],
         },
     }
 
+    if files:
+        config["storage"] = {
+            "files": [
+                {
+                    "path": path,
+                    "mode": 0o644,
+                    "contents": {"source": "data:," + quote(contents)},
+                }
+                for path, contents in files.items()
+            ],
+        }
+
     json_config = json.dumps(config)
     return bytes(json_config, 'utf-8')
 
 
 def get_ami(region):
+    import requests
     res = requests.get("https://builds.coreos.fedoraproject.org/streams/stable.json").json()
     return res['architectures']['x86_64']['images']['aws']['regions'][region]['image']
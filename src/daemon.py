@@ -0,0 +1,219 @@
+import array
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import traceback
+
+from .db import xdg_data_home
+
+POLL_INTERVAL = 30
+
+# held by the poller while it works and by the daemon while it forks, so no
+# command starts life with a lock some other thread was holding
+_fork_lock = threading.Lock()
+
+
+def socket_path():
+    return xdg_data_home() / 'emc' / 'daemon.sock'
+
+
+def _send_msg(conn, data: bytes, fds=()):
+    header = struct.pack('>I', len(data))
+    if fds:
+        conn.sendmsg([header + data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+    else:
+        conn.sendall(header + data)
+
+
+def _recv_exact(conn, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = conn.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _recv_request(conn) -> (dict, [int]):
+    fds = array.array('i')
+    msg, ancdata, _, _ = conn.recvmsg(4, socket.CMSG_SPACE(3 * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    msg += _recv_exact(conn, 4 - len(msg))
+    size, = struct.unpack('>I', msg)
+    return json.loads(_recv_exact(conn, size)), list(fds)
+
+
+# hand argv to a running daemon, along with our stdin, stdout and stderr so
+# the command reads and writes our terminal; returns the command's exit
+# status, or None if there's no daemon to talk to
+def forward(argv: [str]):
+    path = socket_path()
+    if not path.exists():
+        return None
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(str(path))
+    except OSError:
+        conn.close()
+        return None
+
+    with conn:
+        request = dict(argv=argv, cwd=os.getcwd())
+        _send_msg(conn, bytes(json.dumps(request), 'utf-8'), fds=[0, 1, 2])
+        while True:
+            try:
+                status, = struct.unpack('>i', _recv_exact(conn, 4))
+                return status
+            except KeyboardInterrupt:
+                conn.sendall(b'\x03')
+            except ConnectionError:
+                return 1
+
+
+def _run_child(run, request, fds):
+    # leave the daemon's session, so a daemon started in the background of
+    # the client's terminal doesn't make the command a background job there
+    # that stops the moment it reads from it
+    os.setsid()
+    for target, fd in enumerate(fds):
+        if fd != target:
+            os.dup2(fd, target)
+            os.close(fd)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    status = 1
+    try:
+        os.chdir(request['cwd'])
+        status = run(request['argv']) or 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except KeyboardInterrupt:
+        status = 130
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def _watch(conn, pid):
+    # signals only go out while the child is unreaped, so its pid can't have
+    # been handed to some other process yet
+    reaping = threading.Lock()
+    exited = False
+
+    def signal_child(signum):
+        with reaping:
+            if not exited:
+                os.kill(pid, signum)
+
+    def relay_interrupts():
+        while True:
+            try:
+                data = conn.recv(1)
+            except OSError:
+                return
+            if not data:
+                # the client went away, so should its command
+                signal_child(signal.SIGTERM)
+                return
+            signal_child(signal.SIGINT)
+
+    relay = threading.Thread(target=relay_interrupts, daemon=True)
+    relay.start()
+
+    os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+    with reaping:
+        exited = True
+    _, wait_status = os.waitpid(pid, 0)
+    status = os.waitstatus_to_exitcode(wait_status) if hasattr(os, 'waitstatus_to_exitcode') else wait_status >> 8
+    try:
+        conn.sendall(struct.pack('>i', status))
+    except OSError:
+        pass
+
+    # wake the relay thread up so it doesn't outlive the command
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    relay.join()
+    conn.close()
+
+
+def _poll(poller):
+    while True:
+        with _fork_lock:
+            try:
+                poller()
+            except Exception:
+                traceback.print_exc()
+        threading.Event().wait(POLL_INTERVAL)
+
+
+# serve commands on the socket until interrupted; each one runs in a fork of
+# this process, so it starts with everything warmed up here
+def serve(run, poller=None):
+    path = socket_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(path))
+            raise RuntimeError(f"an emc daemon is already listening on {path}")
+        except ConnectionRefusedError:
+            path.unlink()
+        finally:
+            probe.close()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        listener.bind(str(path))
+    finally:
+        os.umask(old_umask)
+    listener.listen()
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    if poller is not None:
+        threading.Thread(target=_poll, args=(poller,), daemon=True).start()
+
+    try:
+        while True:
+            conn, _ = listener.accept()
+            try:
+                request, fds = _recv_request(conn)
+            except (OSError, ValueError):
+                conn.close()
+                continue
+            if len(fds) != 3:
+                for fd in fds:
+                    os.close(fd)
+                conn.close()
+                continue
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+            with _fork_lock:
+                pid = os.fork()
+            if pid == 0:
+                listener.close()
+                conn.close()
+                _run_child(run, request, fds)
+
+            for fd in fds:
+                os.close(fd)
+            threading.Thread(target=_watch, args=(conn, pid), daemon=True).start()
+    finally:
+        listener.close()
+        path.unlink(missing_ok=True)
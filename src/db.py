@@ -1,7 +1,9 @@
 from .meta import EMC_VERSION
 
-from os import environ
+from contextlib import contextmanager
+from os import environ, getpid, replace
 from pathlib import Path
+import fcntl
 import json
 
 def xdg_data_home() -> Path:
@@ -15,11 +17,37 @@ def get_path() -> Path:
     return xdg_data_home() / 'emc' / 'emc.json'
 
 
-def db_write(data: dict):
-    path = get_path()
+# serializes writers of emc.json across processes, e.g. the daemon's poller
+# and the commands it forks
+@contextmanager
+def db_lock():
+    path = get_path().with_name('emc.json.lock')
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open('w') as f:
+    with path.open('a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# replace the file rather than truncating it, so readers never see half of it
+def _write(data: dict):
+    path = get_path()
+    tmp = path.with_name(f"{path.name}.{getpid()}.tmp")
+    with tmp.open('w') as f:
         json.dump(data, f)
+    replace(tmp, path)
+
+
+def _read() -> dict:
+    with get_path().open('r') as f:
+        return json.load(f)
+
+
+def db_write(data: dict):
+    with db_lock():
+        _write(data)
 
 
 def db_read() -> dict:
@@ -27,6 +55,16 @@ def db_read() -> dict:
     if not path.exists():
         db_write(dict(EMC_VERSION=EMC_VERSION))
 
-    with path.open('r') as f:
-        return json.load(f)
+    return _read()
+
 
+# apply update to the current contents of emc.json while holding the lock,
+# for writers that mustn't clobber what others wrote since they last read it;
+# update returns whether it changed anything
+def db_update(update):
+    with db_lock():
+        if not get_path().exists():
+            _write(dict(EMC_VERSION=EMC_VERSION))
+        data = _read()
+        if update(data):
+            _write(data)
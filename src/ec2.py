@@ -1,8 +1,5 @@
-import boto3
-from botocore.exceptions import ClientError
-import requests
-
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 from base64 import b64encode, b64decode
 from uuid import uuid4
 from sys import stderr
@@ -24,18 +21,30 @@ def get_ec2_client(region: str, client_store=None):
     try:
         return clients[region]
     except KeyError:
+        # imported here rather than at the top so a CLI that hands its command
+        # to the daemon never pays for importing boto3
+        import boto3
         clients[region] = boto3.client('ec2', region_name=region)
         return clients[region]
 
 
+# a forked process must not share the parent's pooled HTTP connections
+def forget_connections():
+    for client in _ec2_clients.values():
+        client._endpoint.http_session.close()
+
+
 class Instance:
-    def __init__(self, region: str, instance_id: str, keypair: Keypair, keypair_name: str, ddns_url=None, last_ip=None):
+    def __init__(self, region: str, instance_id: str, keypair: Keypair, keypair_name: str, ddns_url=None, last_ip=None, instance_type=None, worlds=None, network=None):
         self.region = region
         self.instance_id = instance_id
         self.keypair = keypair
         self.keypair_name = keypair_name
         self.ddns_url = ddns_url
         self.last_ip = last_ip
+        self.instance_type = instance_type
+        self.worlds = worlds
+        self.network = network
 
     def to_dict(self):
         return dict(
@@ -45,6 +54,9 @@ class Instance:
                 keypair_name=self.keypair_name,
                 ddns_url=self.ddns_url,
                 last_ip=self.last_ip,
+                instance_type=self.instance_type,
+                worlds=self.worlds,
+                network=self.network,
         )
 
     @classmethod
@@ -56,10 +68,13 @@ class Instance:
                 d['keypair_name'],
                 d.get('ddns_url'),
                 d.get('last_ip'),
+                d.get('instance_type'),
+                d.get('worlds'),
+                d.get('network'),
         )
 
     @classmethod
-    def launch(cls, user_data: bytes, region: str, instance_type: str, ami: str, ports: [['proto', 0]], ddns_url=None) -> 'new instance':
+    def launch(cls, user_data: bytes, region: str, instance_type: str, ami: str, ports: [['proto', 0]], ddns_url=None, extra_groups=()) -> 'new instance':
         keypair = ssh_keygen()
         keypair_name = upload_public_key(region, keypair.public)
         sg_name = security_group(region, ports)
@@ -73,7 +88,7 @@ class Instance:
                     InstanceType=instance_type,
                     KeyName=keypair_name,
                     UserData=user_data,
-                    SecurityGroups=[sg_name],
+                    SecurityGroups=[sg_name, *extra_groups],
                     MinCount=1,
                     MaxCount=1,
             )['Instances']
@@ -81,7 +96,7 @@ class Instance:
                 raise Exception("Couldn't launch it!")
             instance_id = instances[0]['InstanceId']
 
-        instance = cls(region, instance_id, keypair, keypair_name, ddns_url)
+        instance = cls(region, instance_id, keypair, keypair_name, ddns_url, instance_type=instance_type)
 
         if DRY_RUN:
             from random import randrange
@@ -107,6 +122,16 @@ class Instance:
         raise TimeoutError(f"Couldn't get IP after {attempts} attempts")
 
 
+    def wait_private_ip(self, attempts=IP_FETCH_ATTEMPTS):
+        for i in range(attempts):
+            if i:
+                sleep(1)
+            ip = self.get_private_ip()
+            if ip:
+                return ip
+        raise TimeoutError(f"Couldn't get private IP after {attempts} attempts")
+
+
     def update_ddns(self):
         if not self.last_ip:
             self.wait_ip()
@@ -114,17 +139,28 @@ class Instance:
 
 
     def _update_ddns(self, ip):
+        import requests
         url = self.ddns_url.replace("0.0.0.0", ip)
         requests.get(url).raise_for_status()
 
 
-    def terminate(self):
+    # the key pair and DNS record are cleaned up while the instance shuts down;
+    # with wait, return only once EC2 reports it terminated
+    def terminate(self, wait=False):
         ec2 = get_ec2_client(self.region)
         if not DRY_RUN:
             ec2.terminate_instances(InstanceIds=[self.instance_id])
-        ec2.delete_key_pair(KeyName=self.keypair_name)
-        if self.ddns_url:
-            self._update_ddns('127.0.0.1')
+
+        with ThreadPoolExecutor() as pool:
+            cleanup = [pool.submit(ec2.delete_key_pair, KeyName=self.keypair_name)]
+            if self.ddns_url:
+                cleanup.append(pool.submit(self._update_ddns, '127.0.0.1'))
+
+            if wait and not DRY_RUN:
+                ec2.get_waiter('instance_terminated').wait(InstanceIds=[self.instance_id])
+
+            for job in cleanup:
+                job.result()
 
     def get_ip(self):
         ec2 = get_ec2_client(self.region)
@@ -136,6 +172,16 @@ class Instance:
         return self.last_ip
 
 
+    def get_private_ip(self):
+        if DRY_RUN:
+            return f"10.0.{int(self.instance_id[-4:], 16) % 256}.{int(self.instance_id[-2:], 16) % 256}"
+        ec2 = get_ec2_client(self.region)
+        try:
+            return ec2.describe_instances(InstanceIds=[self.instance_id])['Reservations'][0]['Instances'][0]['PrivateIpAddress']
+        except (KeyError, IndexError):
+            return None
+
+
 def upload_public_key(region: str, public_key: bytes) -> 'keypair_name':
     keypair_name = f"emc{EMC_VERSION}-{uuid4()}"
     ec2 = get_ec2_client(region)
@@ -143,10 +189,15 @@ def upload_public_key(region: str, public_key: bytes) -> 'keypair_name':
     return keypair_name
 
 
-# find or make security group with these ports
-def security_group(region: str, ports: [('proto', 0)]) -> 'sg_name':
+# find or make security group with these ports, open to everyone or only to
+# instances in the security group from_group
+def security_group(region: str, ports: [('proto', 0)], from_group=None) -> 'sg_name':
+    from botocore.exceptions import ClientError
+
     ports = sorted(ports)
     name = '-'.join((proto + str(port) for proto, port in ports))
+    if from_group:
+        name += f"-from-{from_group}"
 
     ec2 = get_ec2_client(region)
 
@@ -156,10 +207,15 @@ def security_group(region: str, ports: [('proto', 0)]) -> 'sg_name':
     # create if doesn't exist
     except ClientError:
         desc = "Allow inbound on " + ', '.join((f"port {port} ({proto})" for proto, port in ports))
+        if from_group:
+            desc += f" from {from_group}"
         ec2.create_security_group(Description=desc, GroupName=name)['GroupId']
-        all_ipv4 = [dict(CidrIp="0.0.0.0/0", Description="all ipv4")]
+        if from_group:
+            source = dict(UserIdGroupPairs=[dict(GroupName=from_group)])
+        else:
+            source = dict(IpRanges=[dict(CidrIp="0.0.0.0/0", Description="all ipv4")])
         ec2.authorize_security_group_ingress(GroupName=name, IpPermissions=[
-            dict(IpProtocol=proto, FromPort=port, ToPort=port, IpRanges=all_ipv4) for proto, port in ports
+            dict(IpProtocol=proto, FromPort=port, ToPort=port, **source) for proto, port in ports
         ])
 
     return name
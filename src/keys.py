@@ -1,12 +1,25 @@
 from collections import namedtuple
+from contextlib import contextmanager
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from subprocess import check_call, DEVNULL
+from subprocess import check_call, check_output, run, Popen, DEVNULL
+from time import sleep
+import socket
 
 from .meta import DEFAULT_UNIX_USER
 
 Keypair = namedtuple('Keypair', ('private', 'public'))
 
+# set by the daemon: share one ssh connection per server between commands and
+# keep it open for a while after the last one
+control_dir = None
+
+
+def _control_options() -> [str]:
+    if control_dir is None:
+        return []
+    return ['-o', 'ControlMaster=auto', '-o', f"ControlPath={control_dir}/%C", '-o', 'ControlPersist=10m']
+
 
 def ssh_keygen() -> Keypair:
     with TemporaryDirectory() as tmp_dir:
@@ -20,7 +33,7 @@ def ssh_keygen() -> Keypair:
     return Keypair(private=private_key, public=public_key)
 
 
-def ssh(host: str, private_key: bytes, cmd=None):
+def ssh(host: str, private_key: bytes, cmd=None, stdin: bytes = None):
     with TemporaryDirectory() as tmp_dir:
         private_path = Path(tmp_dir) / "k"
         public_path = Path(tmp_dir) / "k.pub"
@@ -28,11 +41,64 @@ def ssh(host: str, private_key: bytes, cmd=None):
             f.write(private_key)
         private_path.chmod(0o600)
 
-        line = ['ssh', '-F', 'none', '-i', str(private_path), f"{DEFAULT_UNIX_USER}@{host}"]
+        line = ['ssh', '-F', 'none', *_control_options(), '-i', str(private_path), f"{DEFAULT_UNIX_USER}@{host}"]
         if cmd is not None:
             line.append('--')
             line.extend(cmd)
-        check_call(line)
+        if stdin is None:
+            check_call(line)
+        else:
+            run(line, input=stdin, stdout=DEVNULL, check=True)
+
+# run cmd on the server and return what it printed; compressed, since this is
+# used for bulk output like logs
+def ssh_output(host: str, private_key: bytes, cmd) -> bytes:
+    with TemporaryDirectory() as tmp_dir:
+        private_path = Path(tmp_dir) / "k"
+        with private_path.open('wb') as f:
+            f.write(private_key)
+        private_path.chmod(0o600)
+
+        return check_output(['ssh', '-F', 'none', *_control_options(), '-C', '-i', str(private_path), f"{DEFAULT_UNIX_USER}@{host}", '--', *cmd])
+
+
+# forward a local port to a port on the server's loopback interface for as
+# long as the context is open; yields the local port
+@contextmanager
+def ssh_tunnel(host: str, private_key: bytes, remote_port: int, attempts=50):
+    with TemporaryDirectory() as tmp_dir:
+        private_path = Path(tmp_dir) / "k"
+        with private_path.open('wb') as f:
+            f.write(private_key)
+        private_path.chmod(0o600)
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            local_port = s.getsockname()[1]
+
+        line = [
+            'ssh', '-F', 'none', '-i', str(private_path), '-N',
+            '-o', 'ExitOnForwardFailure=yes', '-o', 'StrictHostKeyChecking=accept-new',
+            '-L', f"127.0.0.1:{local_port}:127.0.0.1:{remote_port}",
+            f"{DEFAULT_UNIX_USER}@{host}",
+        ]
+        tunnel = Popen(line, stdin=DEVNULL)
+        try:
+            for i in range(attempts):
+                if tunnel.poll() is not None:
+                    raise ConnectionError(f"ssh tunnel to {host} exited with status {tunnel.returncode}")
+                try:
+                    socket.create_connection(('127.0.0.1', local_port), timeout=1).close()
+                    break
+                except OSError:
+                    sleep(0.2)
+            else:
+                raise TimeoutError(f"ssh tunnel to {host} not up after {attempts} attempts")
+            yield local_port
+        finally:
+            tunnel.terminate()
+            tunnel.wait()
+
 
 def _scp(private_key: bytes, source, dest):
     with TemporaryDirectory() as tmp_dir:
@@ -40,7 +106,7 @@ def _scp(private_key: bytes, source, dest):
         with private_path.open('wb') as f:
             f.write(private_key)
         private_path.chmod(0o600)
-        check_call(['scp', '-i', str(private_path), source, dest])
+        check_call(['scp', *_control_options(), '-i', str(private_path), source, dest])
 
 
 def scp_pull(host: str, private_key: bytes, remote_path, local_path):
@@ -0,0 +1,166 @@
+import json
+import sqlite3
+import zlib
+from datetime import datetime, timezone
+from heapq import merge
+from shlex import quote
+
+from .db import xdg_data_home
+from .keys import ssh_output
+
+# entries are kept in zlib-compressed blocks of up to this many lines; the
+# full-text index only stores terms, not the messages themselves
+BLOCK_SIZE = 1024
+
+SCHEMA = '''\
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS blocks (
+    id INTEGER PRIMARY KEY,
+    first_seq INTEGER NOT NULL,
+    last_seq INTEGER NOT NULL,
+    first_ts INTEGER NOT NULL,
+    last_ts INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_seq ON blocks (first_seq, last_seq);
+CREATE INDEX IF NOT EXISTS blocks_ts ON blocks (first_ts, last_ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(message, content='');
+'''
+
+
+def logs_dir():
+    return xdg_data_home() / 'emc' / 'logs'
+
+
+def indexed_worlds() -> [str]:
+    return sorted(p.stem for p in logs_dir().glob('*.sqlite'))
+
+
+def _message(entry: dict) -> str:
+    message = entry.get('MESSAGE', '')
+    # journald hands out non-utf8 messages as arrays of bytes
+    if isinstance(message, list):
+        return bytes(message).decode('utf-8', 'replace')
+    return message
+
+
+class LogIndex:
+    def __init__(self, world_name: str):
+        path = logs_dir() / (world_name + '.sqlite')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.world_name = world_name
+        self.conn = sqlite3.connect(str(path))
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def cursor(self):
+        row = self.conn.execute("SELECT value FROM state WHERE key = 'cursor'").fetchone()
+        return row[0] if row else None
+
+    def _next_seq(self) -> int:
+        row = self.conn.execute("SELECT max(last_seq) FROM blocks").fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    # journal entries as printed by journalctl -o json, oldest first
+    def add(self, entries: [dict]) -> int:
+        if not entries:
+            return 0
+
+        seq = self._next_seq()
+        with self.conn:
+            for start in range(0, len(entries), BLOCK_SIZE):
+                block = [(int(e['__REALTIME_TIMESTAMP']), _message(e)) for e in entries[start:start + BLOCK_SIZE]]
+                data = zlib.compress(bytes('\n'.join(json.dumps(line) for line in block), 'utf-8'), 9)
+                self.conn.execute(
+                        "INSERT INTO blocks (first_seq, last_seq, first_ts, last_ts, data) VALUES (?, ?, ?, ?, ?)",
+                        (seq, seq + len(block) - 1, block[0][0], block[-1][0], data),
+                )
+                self.conn.executemany(
+                        "INSERT INTO messages (rowid, message) VALUES (?, ?)",
+                        ((seq + i, message) for i, (_, message) in enumerate(block)),
+                )
+                seq += len(block)
+            self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('cursor', ?)", (entries[-1]['__CURSOR'],))
+        return len(entries)
+
+    # yields (timestamp in microseconds, message) in order; search uses sqlite
+    # full-text query syntax
+    def query(self, since: int = None, until: int = None, search: str = None):
+        where = []
+        params = []
+        if since is not None:
+            where.append("last_ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("first_ts <= ?")
+            params.append(until)
+
+        matches = None
+        if search:
+            matches = {row[0] for row in self.conn.execute("SELECT rowid FROM messages WHERE messages MATCH ?", (search,))}
+            if not matches:
+                return
+            where.append("last_seq >= ? AND first_seq <= ?")
+            params.extend([min(matches), max(matches)])
+
+        sql = "SELECT first_seq, data FROM blocks"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY first_seq"
+
+        for first_seq, data in self.conn.execute(sql, params).fetchall():
+            lines = zlib.decompress(data).decode('utf-8').split('\n')
+            for seq, line in enumerate(lines, first_seq):
+                if matches is not None and seq not in matches:
+                    continue
+                ts, message = json.loads(line)
+                if since is not None and ts < since or until is not None and ts > until:
+                    continue
+                yield ts, message
+
+
+def fetch_logs(instance, world_name: str, world: dict) -> int:
+    with LogIndex(world_name) as index:
+        cmd = ['sudo', 'journalctl', '-u', world['unit'], '-o', 'json', '--output-fields=MESSAGE', '--no-pager']
+        if index.cursor:
+            cmd.extend(['--after-cursor', quote(index.cursor)])
+        out = ssh_output(instance.last_ip, instance.keypair.private, cmd)
+        entries = [json.loads(line) for line in out.splitlines() if line.strip()]
+        return index.add(entries)
+
+
+def _tagged(index, query):
+    for ts, message in index.query(**query):
+        yield ts, index.world_name, message
+
+
+# merge the entries of several worlds into one stream ordered by time,
+# yielding (timestamp in microseconds, world name, message)
+def merged_logs(world_names: [str], **query):
+    indexes = [LogIndex(name) for name in world_names]
+    try:
+        streams = [_tagged(index, query) for index in indexes]
+        yield from merge(*streams, key=lambda entry: entry[0])
+    finally:
+        for index in indexes:
+            index.close()
+
+
+def parse_time(s: str) -> int:
+    dt = datetime.fromisoformat(s)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1_000_000)
+
+
+def format_time(ts: int) -> str:
+    return datetime.fromtimestamp(ts / 1_000_000, tz=timezone.utc).isoformat(timespec='milliseconds')
@@ -1,11 +1,152 @@
-from .keys import ssh, scp_pull
-from .meta import DEFAULT_UNIX_USER
+import json
+import socket
+import struct
+from contextlib import contextmanager
+from time import monotonic
 
-def mc_stop(instance):
-    return ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "systemctl", "stop", "minecraft-server"])
+from .keys import ssh, ssh_tunnel, scp_pull
+from .rcon import Rcon
+from .meta import DEFAULT_UNIX_USER, INSTANCE_TYPES, MC_PORT, MAX_WORLDS_PER_HOST
 
-def mc_start(instance):
-    return ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "systemctl", "start", "minecraft-server"])
+def mc_stop(instance, world):
+    return ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "systemctl", "stop", world["unit"]])
 
-def mc_download_world(instance, local_path):
-    return scp_pull(instance.last_ip, instance.keypair.private, "/tmp/minecraft_world.tar.gz", str(local_path))
+def mc_start(instance, world):
+    return ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "systemctl", "start", world["unit"]])
+
+def mc_download_world(instance, world, local_path):
+    return scp_pull(instance.last_ip, instance.keypair.private, world["archive"], str(local_path))
+
+def mc_install_world(instance, world, unit_contents: str):
+    unit_path = f"/etc/systemd/system/{world['unit']}"
+    ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "tee", unit_path], stdin=bytes(unit_contents, 'utf-8'))
+    ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "systemctl", "daemon-reload"])
+    return ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "systemctl", "enable", "--now", world["unit"]])
+
+def mc_remove_world(instance, world):
+    unit_path = f"/etc/systemd/system/{world['unit']}"
+    ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "systemctl", "disable", "--now", world["unit"]])
+    ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "docker", "rm", "-f", world["container"]])
+    return ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "rm", "-f", unit_path])
+
+@contextmanager
+def mc_rcon(instance, world):
+    with ssh_tunnel(instance.last_ip, instance.keypair.private, world["rcon_port"]) as local_port:
+        with Rcon('127.0.0.1', local_port, world["rcon_password"]) as rcon:
+            yield rcon
+
+def mc_exec(instance, world, commands: [str]) -> [str]:
+    with mc_rcon(instance, world) as rcon:
+        return rcon.batch(commands)
+
+
+def memory_mib(memory: '12G') -> int:
+    memory = memory.strip().upper()
+    if memory.endswith('G'):
+        return int(float(memory[:-1]) * 1024)
+    if memory.endswith('M'):
+        return int(float(memory[:-1]))
+    return int(memory)
+
+
+def free_memory(instance_type: str, worlds: dict) -> 'MiB':
+    capacity = memory_mib(INSTANCE_TYPES[instance_type]["jvm_memory"])
+    return capacity - sum(memory_mib(w["memory"]) for w in worlds.values() if w["memory"])
+
+
+def free_port(worlds: dict):
+    used = {w["port"] for w in worlds.values()}
+    for port in range(MC_PORT, MC_PORT + MAX_WORLDS_PER_HOST):
+        if port not in used:
+            return port
+    return None
+
+
+# best fit: the server with the least memory left over after adding the world
+def pick_host(servers: dict, region: str, memory: '12G'):
+    needed = memory_mib(memory)
+    candidates = []
+    for name, spec in servers.items():
+        # servers from older emc versions don't record their instance type;
+        # network backends are only reachable through their proxy
+        if spec.get('region') != region or not spec.get('instance_type') or not spec.get('worlds') or spec.get('network'):
+            continue
+        worlds = spec['worlds']
+        left = free_memory(spec['instance_type'], worlds) - needed
+        if left >= 0 and free_port(worlds) is not None:
+            candidates.append((left, name))
+    if not candidates:
+        return None
+    return min(candidates)[1]
+
+
+def _pack_varint(n: int) -> bytes:
+    n &= 0xffffffff
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _unpack_varint(data: bytes) -> (int, 'size'):
+    n = 0
+    for i, b in enumerate(data[:5]):
+        n |= (b & 0x7f) << (7 * i)
+        if not b & 0x80:
+            return n, i + 1
+    raise ValueError("malformed varint")
+
+
+def _read_varint(sock) -> int:
+    buf = bytearray()
+    while not buf or buf[-1] & 0x80:
+        if len(buf) == 5:
+            raise ValueError("malformed varint")
+        buf.extend(_recv_exact(sock, 1))
+    return _unpack_varint(bytes(buf))[0]
+
+
+def _recv_exact(sock, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed by server")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _send_packet(sock, packet_id: int, payload: bytes = b''):
+    body = _pack_varint(packet_id) + payload
+    sock.sendall(_pack_varint(len(body)) + body)
+
+
+def _recv_packet(sock) -> (int, bytes):
+    body = _recv_exact(sock, _read_varint(sock))
+    packet_id, size = _unpack_varint(body)
+    return packet_id, body[size:]
+
+
+# server list ping, as done by the multiplayer menu of the minecraft client
+def mc_ping(host: str, port: int = MC_PORT, timeout=5.0) -> dict:
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        address = bytes(host, 'utf-8')
+        handshake = _pack_varint(-1) + _pack_varint(len(address)) + address + struct.pack('>H', port) + _pack_varint(1)
+        _send_packet(sock, 0x00, handshake)
+        _send_packet(sock, 0x00)
+
+        _, payload = _recv_packet(sock)
+        length, size = _unpack_varint(payload)
+        status = json.loads(payload[size:size + length].decode('utf-8'))
+
+        start = monotonic()
+        _send_packet(sock, 0x01, struct.pack('>q', 0))
+        _recv_packet(sock)
+        status['latency_ms'] = round((monotonic() - start) * 1000, 1)
+
+    return status
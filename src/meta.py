@@ -3,11 +3,25 @@ EMC_VERSION = "0.0.1"
 DEFAULT_ICON = "https://cdn.drawception.com/images/panels/2017/5-11/WQKtsM529c-1.png"
 DEFAULT_INSTANCE_TYPE = "t3.xlarge"
 DEFAULT_MOTD = f"ephemeral minecraft server (emc{EMC_VERSION})"
-DEFAULT_OPEN_PORTS = [("tcp", 22), ("tcp", 25565), ("udp", 25565)]
 DEFAULT_REGION = "eu-central-1"
 DEFAULT_UNIX_USER = 'core'
 DRY_RUN = False
 IP_FETCH_ATTEMPTS = 30
+MC_PORT = 25565
+MAX_WORLDS_PER_HOST = 8
+RCON_PORT = 25575
+DEFAULT_TRIM_SECONDS = 30
+
+# each world on an instance gets its own port, counting up from MC_PORT
+DEFAULT_OPEN_PORTS = [("tcp", 22)] + [(proto, MC_PORT + i) for i in range(MAX_WORLDS_PER_HOST) for proto in ("tcp", "udp")]
+
+# a network is one proxy instance in front of several backend instances; only
+# the proxy is reachable by players
+DEFAULT_PROXY_INSTANCE_TYPE = "t3.small"
+DEFAULT_NETWORK_BACKENDS = 2
+PROXY_OPEN_PORTS = [("tcp", 22), ("tcp", MC_PORT)]
+BACKEND_OPEN_PORTS = [("tcp", 22)]
+BACKEND_PROXIED_PORTS = [("tcp", MC_PORT)]
 
 # the prices listed here may be out of date!
 INSTANCE_TYPES = {
@@ -0,0 +1,97 @@
+import gzip
+import struct
+import zlib
+
+TAG_END = 0
+TAG_BYTE = 1
+TAG_SHORT = 2
+TAG_INT = 3
+TAG_LONG = 4
+TAG_FLOAT = 5
+TAG_DOUBLE = 6
+TAG_BYTE_ARRAY = 7
+TAG_STRING = 8
+TAG_LIST = 9
+TAG_COMPOUND = 10
+TAG_INT_ARRAY = 11
+TAG_LONG_ARRAY = 12
+
+_scalars = {
+    TAG_BYTE: struct.Struct('>b'),
+    TAG_SHORT: struct.Struct('>h'),
+    TAG_INT: struct.Struct('>i'),
+    TAG_LONG: struct.Struct('>q'),
+    TAG_FLOAT: struct.Struct('>f'),
+    TAG_DOUBLE: struct.Struct('>d'),
+}
+
+_arrays = {
+    TAG_BYTE_ARRAY: 'b',
+    TAG_INT_ARRAY: 'i',
+    TAG_LONG_ARRAY: 'q',
+}
+
+
+class NBTError(Exception):
+    pass
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def take(self, size: int) -> bytes:
+        if self.pos + size > len(self.data):
+            raise NBTError("unexpected end of NBT data")
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return chunk
+
+    def unpack(self, s: struct.Struct):
+        return s.unpack(self.take(s.size))[0]
+
+    def string(self) -> str:
+        size = self.unpack(_scalars[TAG_SHORT]) & 0xffff
+        return self.take(size).decode('utf-8', 'replace')
+
+    def payload(self, tag: int):
+        if tag in _scalars:
+            return self.unpack(_scalars[tag])
+        if tag in _arrays:
+            size = self.unpack(_scalars[TAG_INT])
+            return list(struct.unpack(f'>{size}{_arrays[tag]}', self.take(size * struct.calcsize(_arrays[tag]))))
+        if tag == TAG_STRING:
+            return self.string()
+        if tag == TAG_LIST:
+            item_tag = self.unpack(_scalars[TAG_BYTE])
+            size = self.unpack(_scalars[TAG_INT])
+            return [self.payload(item_tag) for _ in range(size)]
+        if tag == TAG_COMPOUND:
+            compound = dict()
+            while True:
+                item_tag = self.unpack(_scalars[TAG_BYTE])
+                if item_tag == TAG_END:
+                    return compound
+                name = self.string()
+                compound[name] = self.payload(item_tag)
+        raise NBTError(f"unknown NBT tag {tag}")
+
+
+# returns the root compound of uncompressed NBT data
+def loads(data: bytes) -> dict:
+    reader = _Reader(data)
+    tag = reader.unpack(_scalars[TAG_BYTE])
+    if tag != TAG_COMPOUND:
+        raise NBTError("NBT root is not a compound")
+    reader.string()
+    return reader.payload(tag)
+
+
+# level.dat and friends are gzipped, region file chunks usually zlib'd
+def loads_compressed(data: bytes) -> dict:
+    if data[:2] == b'\x1f\x8b':
+        return loads(gzip.decompress(data))
+    if data[:1] == b'\x78':
+        return loads(zlib.decompress(data))
+    return loads(data)
@@ -0,0 +1,45 @@
+import json
+
+from .keys import ssh
+from .meta import MC_PORT
+
+PROXY = dict(
+        port=MC_PORT,
+        container="proxy",
+        unit="minecraft-proxy.service",
+        data="/var/lib/velocity",
+        console="/var/lib/velocity/console",
+        config="/var/lib/velocity/velocity.toml",
+)
+
+
+# backends run in offline mode and are only reachable from the proxy, which
+# does the authentication
+BACKEND_ENV = dict(ONLINE_MODE="FALSE")
+
+
+def velocity_toml(backends: {'name': 'ip:port'}, motd: str) -> str:
+    lines = [
+        'config-version = "2.5"',
+        'bind = "0.0.0.0:25577"',
+        f'motd = {json.dumps(motd)}',
+        'online-mode = true',
+        'player-info-forwarding-mode = "none"',
+        '',
+        '[servers]',
+    ]
+    lines.extend(f'{json.dumps(name)} = {json.dumps(address)}' for name, address in sorted(backends.items()))
+    lines.append(f'try = {json.dumps(sorted(backends))}')
+    lines.extend(['', '[forced-hosts]', ''])
+    return '\n'.join(lines)
+
+
+def network_console(instance, command: str):
+    return ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "tee", "-a", PROXY["console"]], stdin=bytes(command + '\n', 'utf-8'))
+
+
+# rewrite the proxy's backend list and have it pick up the change without
+# dropping connected players
+def network_set_backends(instance, backends: {'name': 'ip:port'}, motd: str):
+    ssh(instance.last_ip, instance.keypair.private, cmd=["sudo", "tee", PROXY["config"]], stdin=bytes(velocity_toml(backends, motd), 'utf-8'))
+    return network_console(instance, "velocity reload")
@@ -0,0 +1,100 @@
+import socket
+import struct
+
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+# minecraft answers packets of unknown type with a single "Unknown request"
+# packet; sent after a command's first response packet, its answer marks the
+# end of that command's response
+SENTINEL_TYPE = 200
+
+
+class RconError(Exception):
+    pass
+
+
+class Rcon:
+    def __init__(self, host: str, port: int, password: str, timeout=10.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self.next_id = 1
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.rfile = self.sock.makefile('rb')
+        request_id = self._send(SERVERDATA_AUTH, self.password)
+        while True:
+            response_id, response_type, _ = self._recv()
+            if response_type == SERVERDATA_AUTH_RESPONSE:
+                break
+        if response_id != request_id:
+            self.close()
+            raise RconError(f"RCON authentication failed for {self.host}:{self.port}")
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+
+    # the vanilla server drops the connection if one read() holds more than a
+    # packet, so every packet waits for the answer to the previous one
+    def command(self, command: str) -> str:
+        request_id = self._send(SERVERDATA_EXECCOMMAND, command)
+        parts = [self._recv_response(request_id)]
+
+        # responses too long for one packet continue in more packets
+        sentinel = self._send(SENTINEL_TYPE, '')
+        while True:
+            response_id, body = self._recv_checked()
+            if response_id == sentinel:
+                return ''.join(parts)
+            if response_id == request_id:
+                parts.append(body)
+
+    # run commands one after another over the same connection
+    def batch(self, commands: [str]) -> [str]:
+        return [self.command(command) for command in commands]
+
+    def _recv_response(self, request_id: int) -> str:
+        while True:
+            response_id, body = self._recv_checked()
+            if response_id == request_id:
+                return body
+
+    def _recv_checked(self) -> (int, str):
+        response_id, _, body = self._recv()
+        if response_id == -1:
+            raise RconError("RCON session is no longer authenticated")
+        return response_id, body
+
+    def _send(self, packet_type: int, body: str) -> int:
+        request_id = self.next_id
+        self.next_id += 1
+        payload = struct.pack('<ii', request_id, packet_type) + bytes(body, 'utf-8') + b'\0\0'
+        self.sock.sendall(struct.pack('<i', len(payload)) + payload)
+        return request_id
+
+    def _recv(self) -> (int, int, str):
+        header = self.rfile.read(4)
+        if len(header) < 4:
+            raise ConnectionError("RCON connection closed by server")
+        length, = struct.unpack('<i', header)
+        payload = self.rfile.read(length)
+        if len(payload) < length:
+            raise ConnectionError("RCON connection closed by server")
+        response_id, response_type = struct.unpack('<ii', payload[:8])
+        return response_id, response_type, payload[8:-2].decode('utf-8', 'replace')
@@ -0,0 +1,170 @@
+import re
+import struct
+import tarfile
+import zlib
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+
+from . import anvil, nbt
+from .db import xdg_data_home
+
+SNAPSHOT_SUFFIX = '.tar.gz'
+
+# minecraft_world_<world>_<time>, or minecraft_world_<time> for saves from
+# before emc could run more than one world per server
+_snapshot_re = re.compile(r'minecraft_world_(?:(?P<world>.+)_)?(?P<time>\d{4}-\d{2}-\d{2}T\d{6})')
+
+
+# what reading or trimming a damaged or truncated archive can raise
+SNAPSHOT_ERRORS = (tarfile.TarError, OSError, EOFError, zlib.error, struct.error, ValueError, nbt.NBTError)
+
+
+def worlds_dir() -> Path:
+    return xdg_data_home() / 'emc' / 'worlds'
+
+
+def snapshot_id(path: Path) -> str:
+    return path.name[:-len(SNAPSHOT_SUFFIX)]
+
+
+def _level_info(level: dict) -> dict:
+    data = level.get('Data', {})
+    seed = data.get('WorldGenSettings', {}).get('seed', data.get('RandomSeed'))
+    return dict(
+            level_name=data.get('LevelName'),
+            version=data.get('Version', {}).get('Name'),
+            seed=seed,
+    )
+
+
+# read the metadata of a saved world in one pass over the archive, without
+# unpacking it to disk
+def snapshot_info(path: Path, server=None, world=None, saved=None) -> dict:
+    m = _snapshot_re.fullmatch(snapshot_id(path))
+    if m and saved is None:
+        saved = datetime.strptime(m['time'], '%Y-%m-%dT%H%M%S').isoformat()
+    if m and world is None:
+        world = m['world']
+
+    info = dict(
+            file=path.name,
+            name=None,
+            world=world,
+            server=server,
+            saved=saved or datetime.utcfromtimestamp(path.stat().st_mtime).isoformat(timespec='seconds'),
+            archive_size=path.stat().st_size,
+            size=0,
+            level_name=None,
+            version=None,
+            seed=None,
+    )
+
+    level_depth = None
+    with tarfile.open(path, 'r|gz') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            info['size'] += member.size
+            member_path = PurePosixPath(member.name)
+            if member_path.name != 'level.dat':
+                continue
+            if level_depth is not None and len(member_path.parts) >= level_depth:
+                continue
+            try:
+                info.update(_level_info(nbt.loads_compressed(tar.extractfile(member).read())))
+                level_depth = len(member_path.parts)
+            except (nbt.NBTError, OSError, EOFError):
+                pass
+
+    return info
+
+
+# bring the catalog up to date with the worlds directory; archives that were
+# saved by older emc versions or copied in by hand get scanned once
+def sync_catalog(db) -> bool:
+    catalog = db.setdefault('snapshots', dict())
+    on_disk = {snapshot_id(p): p for p in worlds_dir().glob('*' + SNAPSHOT_SUFFIX)}
+
+    changed = False
+    for key in set(catalog) - set(on_disk):
+        del catalog[key]
+        changed = True
+    for key in set(on_disk) - set(catalog):
+        try:
+            catalog[key] = snapshot_info(on_disk[key])
+        except (tarfile.TarError, OSError, EOFError):
+            continue
+        changed = True
+    return changed
+
+
+def find_snapshot(db, key: str) -> str:
+    catalog = db.get('snapshots', {})
+    if key in catalog:
+        return key
+    for snapshot, info in catalog.items():
+        if info.get('name') == key:
+            return snapshot
+    raise KeyError(key)
+
+
+# which snapshots a retention policy keeps: per source world, the newest
+# keep_last, plus the newest of each of the `daily` most recent days and the
+# `weekly` most recent weeks that have saves. Named snapshots are always kept.
+def retained(catalog: dict, keep_last=None, daily=None, weekly=None) -> set:
+    if keep_last is None and daily is None and weekly is None:
+        return set(catalog)
+
+    keep = {key for key, info in catalog.items() if info.get('name')}
+
+    by_world = dict()
+    for key, info in catalog.items():
+        by_world.setdefault(info.get('world'), []).append((info['saved'], key))
+
+    for snapshots in by_world.values():
+        snapshots.sort(reverse=True)
+        keep.update(key for _, key in snapshots[:keep_last or 0])
+
+        for periods, bucket in ((daily, lambda t: t.date()), (weekly, lambda t: t.isocalendar()[:2])):
+            seen = set()
+            for saved, key in snapshots:
+                if len(seen) >= (periods or 0):
+                    break
+                b = bucket(datetime.fromisoformat(saved))
+                if b not in seen:
+                    seen.add(b)
+                    keep.add(key)
+
+    return keep
+
+
+def prune(db, dry_run=False, **policy) -> [str]:
+    catalog = db.get('snapshots', {})
+    doomed = sorted(set(catalog) - retained(catalog, **policy))
+    if not dry_run:
+        for key in doomed:
+            (worlds_dir() / catalog.pop(key)['file']).unlink(missing_ok=True)
+    return doomed
+
+
+# drop chunks that players spent less than below_seconds near from a saved
+# world, rewriting its archive in place; returns the analysis of every region
+# and the chunks that were (or, for a dry run, would be) dropped
+def trim_snapshot(db, key: str, below_seconds: float, dry_run=False) -> ('analysis', 'drop'):
+    info = db['snapshots'][key]
+    path = worlds_dir() / info['file']
+
+    analysis = list(anvil.analyze_archive(path))
+    drop = anvil.chunks_below(analysis, int(below_seconds * anvil.TICKS_PER_SECOND))
+    if dry_run or not drop:
+        return analysis, drop
+
+    tmp = path.with_name(path.name + '.trimming')
+    try:
+        anvil.trim_archive(path, tmp, drop)
+        tmp.replace(path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    db['snapshots'][key] = dict(snapshot_info(path, info['server'], info['world'], info['saved']), name=info.get('name'))
+    return analysis, drop
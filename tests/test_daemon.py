@@ -0,0 +1,94 @@
+import os
+import pty
+import select
+import signal
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import src.daemon as daemon  # noqa: E402
+
+TIMEOUT = 10
+
+
+def _answer(argv):
+    print(f"got {input()}")
+    return 3
+
+
+# runs as the session leader of a pty, like a login shell: the daemon goes in
+# a background process group, as with `./emc.py daemon &`, and the client
+# stays in the foreground
+def _session():
+    # the test runner may have swapped these for its own capturing objects
+    sys.stdin, sys.stdout, sys.stderr = sys.__stdin__, sys.__stdout__, sys.__stderr__
+
+    daemon_pid = os.fork()
+    if daemon_pid == 0:
+        os.setpgid(0, 0)
+        try:
+            daemon.serve(_answer)
+        finally:
+            os._exit(0)
+
+    status = 1
+    try:
+        deadline = time.monotonic() + TIMEOUT
+        while not daemon.socket_path().exists() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        status = daemon.forward(['answer'])
+    finally:
+        os.kill(daemon_pid, signal.SIGTERM)
+        os.waitpid(daemon_pid, 0)
+        os._exit(127 if status is None else status)
+
+
+class TestForwardFromTerminal(unittest.TestCase):
+    def setUp(self):
+        self.data_home = tempfile.TemporaryDirectory()
+        self.old_data_home = os.environ.get('XDG_DATA_HOME')
+        os.environ['XDG_DATA_HOME'] = self.data_home.name
+
+    def tearDown(self):
+        if self.old_data_home is None:
+            del os.environ['XDG_DATA_HOME']
+        else:
+            os.environ['XDG_DATA_HOME'] = self.old_data_home
+        self.data_home.cleanup()
+
+    def test_input_with_daemon_in_background(self):
+        pid, master = pty.fork()
+        if pid == 0:
+            _session()
+
+        os.write(master, b'hello\n')
+        output = b''
+        deadline = time.monotonic() + TIMEOUT
+        try:
+            while time.monotonic() < deadline:
+                ready, _, _ = select.select([master], [], [], 0.1)
+                if ready:
+                    try:
+                        output += os.read(master, 1024)
+                    except OSError:
+                        pass
+                done, wait_status = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    break
+            else:
+                os.killpg(pid, signal.SIGKILL)
+                _, wait_status = os.waitpid(pid, 0)
+                self.fail(f"forwarded command hung reading the terminal; output so far: {output!r}")
+        finally:
+            os.close(master)
+
+        self.assertIn(b'got hello', output)
+        self.assertEqual(os.waitstatus_to_exitcode(wait_status), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()